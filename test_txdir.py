@@ -2,6 +2,7 @@ import sys
 import os
 import io
 import shutil
+import json
 from subprocess import run as sprun, PIPE
 from base64 import b64encode
 import pytest
@@ -21,6 +22,7 @@ fromcmds = txdir.TxDir.fromcmds
 @pytest.fixture(scope="module",params=[True,False])
 def u8(request):
     yes = request.param
+    chars = txdir._tree_chars()
     global Z
     global MID
     global END
@@ -40,6 +42,8 @@ def u8(request):
        END = "`"
        VER = "|"
        HOR = "-"
+    yield yes
+    txdir.set_tree_chars(**chars)
 
 if 'win' in sys.platform:
    txcmd = f'{here}\\txdir.py'
@@ -576,5 +580,796 @@ r/a/x.txt
 r/a/x.txt
    Text in x'''
 
+def test_stats(tmpworkdir,u8):
+    txdir.flat_to_tree(['t/a/aa.txt','    this is aa','t/b/'])
+    st = txdir.Stats()
+    lns = list(txdir.tree_to_view('t',stats=st))
+    assert st.counters['filecontent'] == 1
+    assert st.counters['filecontent_bytes'] == len('this is aa\n')
+    assert st.counters['listdir'] >= 3
+    st = txdir.Stats()
+    os.makedirs('u')
+    with txdir.with_cwd('u'):
+        txdir.to_tree(lns,stats=st)
+    assert st.counters['mkdir'] == 2
+    assert st.counters['filewrite'] == 1
+    assert st.counters['regex'] > 0
+    assert 'filewrite' in st.timings
+    r = run([txcmd,'t','-s','-l'],stdout=PIPE,stderr=PIPE)
+    assert r.returncode == 0
+    import json
+    rep = json.loads(r.stderr.decode('utf-8'))
+    assert rep['counters']['lines'] == 3
+    assert 'scan' in rep['timings']
+
+def test_sharded(tmpworkdir,u8):
+    lst = []
+    for a in 'abcd':
+        for b in 'xy':
+            lst += [f't/{a}/{b}/f.txt','    in '+a+b,'',f't/{a}/{b}/.h.txt','    dot']
+    lst += ['t/e/','t/z.txt','    z','t/a/l -> ../b','t/c/x/y/z/']
+    txdir.flat_to_tree(lst)
+    with open('t/.gitignore','w') as f:
+        f.write('y/\n')
+    for kw in (dict(),dict(with_dot=True),dict(maxdepth=2),dict(with_content=False)):
+        for sd in (1,2):
+            for fun in (txdir.tree_to_view,txdir.tree_to_flat):
+                serial = list(fun('t',**kw))
+                st = txdir.Stats()
+                sharded = list(fun('t',jobs=2,sharddepth=sd,stats=st,**kw))
+                assert sharded == serial
+                assert st.counters['listdir'] > 0
+    r = run([txcmd,'t','-j','3']+([Z]if Z else[]),stdout=PIPE)
+    assert r.returncode == 0
+    assert r.stdout.decode('utf-8').splitlines() == list(txdir.tree_to_view('t'))
+
+def test_parallel_apply(tmpworkdir,u8):
+    lst = []
+    for a in 'abcdef':
+        for b in 'xy':
+            lst += [f'r/{a}/{b}/f.txt','    in '+a+b,'',f'r/{a}/{b}/g/']
+    lst += ['r/a/l -> /r/b/x','r/z.txt','    z']
+    for fun in (lambda: lst,lambda: list(txdir.tree_to_view('s'))):
+        os.makedirs('s')
+        with txdir.with_cwd('s'):
+            txdir.flat_to_tree(lst)
+        lines = fun()
+        for o,j in (('o1',0),('o2',3)):
+            os.makedirs(o)
+            st = txdir.Stats()
+            with txdir.with_cwd(o):
+                txdir.to_tree(lines,stats=st,jobs=j)
+            assert st.counters['filewrite'] == 13
+        assert list(txdir.tree_to_flat('o1')) == list(txdir.tree_to_flat('o2'))
+        assert os.readlink('o2/r/a/l') == os.readlink('o1/r/a/l')
+        for x in ('s','o1','o2'):
+            shutil.rmtree(x)
+
+def test_async(tmpworkdir,u8,monkeypatch):
+    import asyncio
+    txdir.flat_to_tree(['s/a/aa.txt','    this is aa','s/b/c/','s/b/l -> ../a'
+                        ,'s/d/e/f.txt','    f','s/d/e/g.txt','    g\n    g','s/d/h -> e/f.txt'])
+    async def scan(fun,**kw):
+        return [x async for x in fun('s',**kw)]
+    assert asyncio.run(scan(txdir.atree_to_view,batch=2)) == list(txdir.tree_to_view('s'))
+    assert asyncio.run(scan(txdir.atree_to_flat)) == list(txdir.tree_to_flat('s'))
+    async def first(fun):
+        async for x in fun('s',batch=1):
+            return x
+    assert asyncio.run(first(txdir.atree_to_flat)) == 'a/aa.txt'
+    class NoLock:
+        def acquire(self): raise AssertionError("chdir")
+    monkeypatch.setattr(txdir,'_cdlock',NoLock())
+    for fun in (txdir.tree_to_view,txdir.tree_to_flat):
+        for batch in (1,2,1000):
+            shutil.rmtree('o',ignore_errors=True)
+            asyncio.run(txdir.ato_tree(iter(list(fun('s'))),'o',batch=batch))
+            assert list(txdir.tree_to_flat('o')) == list(txdir.tree_to_flat('s'))
+    parts = txdir._view_parts(list(txdir.tree_to_view('s')),txdir._rex(),'x',mkdir=lambda d:None,maxlines=2)
+    assert [d for d,_ in parts] == ['x/a','x/b','x/b','x/d/e','x/d/e','x/d'] #large directories split
+    flat = list(txdir.tree_to_flat('s'))
+    assert [len(ln) for _,ln in txdir._split_flat([('',flat)],3)] == [3,3,3,1]
+
+def test_grammar(tmpworkdir,u8):
+    g = txdir._rex()
+    assert txdir._rex() is g
+    v='''\
+└─ t/
+   ├─ a/
+   │  └─ b/
+   │     └─ c.txt
+               this is c
+   └─ d.txt
+         this is d'''.replace('─',HOR).replace('└',END).replace('├',MID).replace('│',VER).splitlines()
+    st = txdir.Stats()
+    txdir.view_to_tree(v,stats=st)
+    #classification once per line, one match for each entry start and each entry
+    assert st.counters['regex'] == len(v)+2*5
+    assert open('t/a/b/c.txt').read() == 'this is c\n'
+    assert open('t/d.txt').read() == 'this is d\n'
+
+def test_detect_format(tmpworkdir,u8):
+    def fmt(v):
+        return txdir.detect_format(v.replace('├',MID).replace('└',END).splitlines())[0]
+    assert fmt('└─ a/') == 'view'
+    assert fmt('\n\n    tmpt\n    └─ a') == 'view'
+    assert fmt('tmpt\n└─ a') == 'view'
+    assert fmt('a/b.txt\n   text\nc.txt\n   ├─ text') == 'flat'
+    assert fmt('a/') == 'flat'
+    assert fmt('') == 'flat'
+    consumed = []
+    def lines():
+        for x in ['a/b.txt','   in b','c/d/','e.txt']:
+            consumed.append(x)
+            yield x
+    f,it = txdir.detect_format(lines())
+    assert f == 'flat'
+    assert consumed == ['a/b.txt','   in b']
+    assert list(it) == ['a/b.txt','   in b','c/d/','e.txt']
+    txdir.to_tree(lines())
+    assert open('a/b.txt').read() == 'in b\n'
+    assert os.path.isdir('c/d')
+    assert os.path.exists('e.txt')
+    txdir.to_tree(['x/',VER+' y'],fmt='flat')
+    assert os.path.isdir('x')
+
+def test_mmap(tmpworkdir,u8,monkeypatch):
+    txt = ''.join(f'line {i}  \n' if i%3 else '\n' for i in range(1,1000))+'no end  '
+    with open('a.txt','w') as f:
+        f.write(txt)
+    with open('b.txt','w',newline='') as f:
+        f.write('a\r\nb\rc\n')
+    with open('c.bin','wb') as f:
+        f.write(b'abc\xff'*10)
+    expected = list(txdir.tree_to_view('.',with_binary=True))
+    monkeypatch.setattr(txdir,'MMAPSIZE',10)
+    mapped = txdir.filecontent('a.txt')
+    assert isinstance(mapped,txdir.MappedLines)
+    assert list(mapped) == txt.splitlines(keepends=True)
+    assert list(mapped._chunks(chunk=100))[0].endswith('\n')
+    assert isinstance(txdir.filecontent('b.txt'),list)
+    assert txdir.filecontent('c.bin') is None
+    assert list(txdir.tree_to_view('.',with_binary=True)) == expected
+
+def test_copy(tmpworkdir,u8):
+    txdir.flat_to_tree(['s/a/aa.txt','    this is aa','s/b/c/','s/b/l -> ../a','s/.d.txt','    dot','s/i/x.txt'])
+    with open('s/.gitignore','w') as f:
+        f.write('i\n')
+    with open('s/a/bin','wb') as f:
+        f.write(b'\x00\xff'*1000)
+    expected = list(txdir.tree_to_flat('s',with_binary=True))
+    st = txdir.Stats()
+    txdir.tree_to_tree('s','s/o',stats=st)
+    assert st.counters['filecopy'] == 2
+    assert st.counters['filecopy_bytes'] == 2000+len('this is aa\n')
+    assert list(txdir.tree_to_flat('s/o',with_binary=True)) == expected
+    assert open('s/o/a/bin','rb').read() == b'\x00\xff'*1000
+    assert os.readlink('s/o/b/l') == '../a'
+    assert not os.path.exists('s/o/.d.txt')
+    assert not os.path.exists('s/o/i')
+    assert not os.path.exists('s/o/o')
+    txdir.main(infile='s',outdir='t',n=True,d=True)
+    assert os.path.exists('t/.d.txt')
+    assert os.path.getsize('t/a/aa.txt') == 0
+
+def test_walk(tmpworkdir,u8):
+    d = fromcmds(['a/b/c,e','f'])
+    txdir.TxDir('x.txt',d('a/b'),('line 1\n','\n','line 3\n'))
+    txdir.TxDir('l',d('a'),'b/x.txt')
+    deep = d('f')
+    for i in range(2000):
+        deep = txdir.TxDir('n',deep)
+    assert [(p,e.path()) for p,e in d.walk()] == [(e.path(),e.path()) for e in d]
+    assert [p for p,e in d('a').walk()][:3] == ['a/b/c','a/b/e','a/b/x.txt']
+    assert d('a').flat() == '''\
+a/b/c/
+a/b/e/
+a/b/x.txt
+   line 1
+
+   line 3
+a/l -> b/x.txt
+'''
+    assert d.flat().endswith('/n/n/\n')
+    d('a').tree()
+    assert open('a/b/x.txt').read() == 'line 1\n\nline 3\n'
+    assert os.readlink('a/l') == 'b/x.txt'
+
+def test_view_scales(u8):
+    def calls(n):
+        d = txdir.TxDir()
+        for i in range(n):
+            txdir.TxDir(f'f{i:06}',d('.'),('text',))
+        count = [0]
+        def profile(frame,event,arg):
+            if event == 'call':
+                count[0] += 1
+        old = sys.getprofile()
+        sys.setprofile(profile)
+        try:
+            v = d.view()
+        finally:
+            sys.setprofile(old)
+        assert v.count('\n') == 2*n-1
+        return count[0]
+    c1,c4 = calls(200),calls(800)
+    assert c4 <= 4*c1 #linear: ~4, quadratic: ~16
+
+def test_fromview_nolock(u8,monkeypatch):
+    class NoLock:
+        def acquire(self): raise AssertionError("lock taken")
+    monkeypatch.setattr(txdir,'_cdlock',NoLock())
+    d = txdir.TxDir()
+    for i in range(50):
+        s = txdir.TxDir(f'd{i}',d,[])
+        for j in range(50):
+            txdir.TxDir(f'f{j}',s,('x\n',' y\n'))
+    txdir.TxDir('l',d,'d0/f0')
+    v,f = d.view(),d.flat()
+    assert fromview(v).view() == v
+    assert txdir.TxDir.fromview(v.splitlines()).view() == v
+    assert txdir.TxDir.fromflat(f).flat() == f
+    assert txdir.TxDir.fromflat(iter(f.splitlines())).flat() == f
+
+def test_staged(tmpworkdir,u8,monkeypatch):
+    txdir.flat_to_tree(['o/a.txt','    old','o/b/c.txt','    old c','o/l -> a.txt'])
+    os.chmod('o/a.txt',0o755)
+    before = list(txdir.tree_to_flat('o'))
+    with pytest.raises(RuntimeError):
+        with txdir.staged('o') as stage, txdir.with_cwd(stage):
+            txdir.flat_to_tree(['a.txt','    new','d/'])
+            raise RuntimeError('halfway')
+    assert list(txdir.tree_to_flat('o')) == before
+    assert os.listdir('.') == ['o']
+    for exchange in (txdir.exchange,lambda a,b:False):
+        st = txdir.Stats()
+        with txdir.staged('o',stats=st,exchange=exchange) as stage, txdir.with_cwd(stage):
+            txdir.flat_to_tree(['a.txt','    new','d/'])
+        assert set(st.timings) >= {'stage','sync','swap'}
+        assert open('o/a.txt').read() == 'new\n'
+        assert open('o/b/c.txt').read() == 'old c\n'
+        assert os.readlink('o/l') == 'a.txt'
+        assert os.stat('o/a.txt').st_mode & 0o777 == 0o755
+        assert os.listdir('.') == ['o']
+    rename = os.rename
+    def failing(a,b):
+        if a.endswith('.stage'):
+            raise OSError('no space')
+        rename(a,b)
+    monkeypatch.setattr(os,'rename',failing)
+    with pytest.raises(OSError):
+        with txdir.staged('o',exchange=lambda a,b:False) as stage, txdir.with_cwd(stage):
+            txdir.flat_to_tree(['a.txt','    newer'])
+    monkeypatch.setattr(os,'rename',rename)
+    assert open('o/a.txt').read() == 'new\n' and os.listdir('.') == ['o']
+    stages = []
+    def spy(outdir,**kw):
+        stages.append(outdir)
+        return staged(outdir,**kw)
+    staged = txdir.staged
+    monkeypatch.setattr(txdir,'staged',spy)
+    txdir.main(infile='o',outdir='n',x=True) #copy
+    txdir.main(infile='o',outdir='n',x=True)
+    assert sorted(os.listdir('.')) == ['n','o']
+    assert list(txdir.tree_to_flat('n')) == list(txdir.tree_to_flat('o'))
+    with open('v','w') as f:
+        f.write('\n'.join(txdir.tree_to_view('o')))
+    txdir.main(infile='v',outdir='m',x=True) #apply from a view
+    assert stages == ['n','n','m']
+    assert sorted(os.listdir('.')) == ['m','n','o','v']
+    assert list(txdir.tree_to_flat('m')) == list(txdir.tree_to_flat('o'))
+    txdir.main(infile='o',outdir='p',c=['x/y']) #copy, then -c into the copy
+    txdir.main(infile='o',outdir='q',c=['x/y'],x=True) #both in the one stage
+    assert stages == ['n','n','m','q']
+    for d in ('p','q'):
+        assert os.path.isdir(d+'/x/y')
+        assert open(d+'/a.txt').read() == 'new\n'
+
+def test_dump_load(tmpworkdir,u8):
+    d = fromcmds(['a/b/c,e','f'])
+    txdir.TxDir('x.txt',d('a/b'),('line 1\n','\n','  ünicode\n','no end'))
+    txdir.TxDir('bin',d('a'),(repr(b64encode(b'\x00\xff')),))
+    txdir.TxDir('empty',d('a'),())
+    txdir.TxDir('l',d('a'),'b/x.txt')
+    with open('snap','wb') as f:
+        d.dump(f)
+    for lazy in (False,True):
+        with open('snap','rb') as f:
+            e = txdir.TxDir.load(f,lazy=lazy)
+        assert [(p,x.content) for p,x in e.walk()] == [(p,x.content) for p,x in d.walk()]
+        assert e.flat() == d.flat()
+        assert e.view() == d.view()
+        assert e('a/l').islink() and e('a/bin').isfile() and e('f').isdir()
+    with open('snap','wb') as f:
+        d('a/b').dump(f)
+    with open('snap','rb') as f:
+        assert txdir.TxDir.load(f).flat() == d('a/b').flat()[len('a/b/'):].replace('\na/b/','\n')
+    with open('snap','wb') as f:
+        f.write(b'not a snapshot'*3)
+    with open('snap','rb') as f, pytest.raises(ValueError):
+        txdir.TxDir.load(f)
+    with open('snap','wb') as f:
+        d.dump(f)
+    whole = open('snap','rb').read()
+    for cut in (10,len(whole)-1):
+        with open('snap','wb') as f:
+            f.write(whole[:cut])
+        for lazy in (False,True):
+            with open('snap','rb') as f, pytest.raises(ValueError,match='truncated'):
+                txdir.TxDir.load(f,lazy=lazy)
+
+@pytest.mark.skipif(not shutil.which('git'),reason='needs git to make the index')
+@pytest.mark.parametrize('version',[2,3,4])
+def test_gitindex(tmpworkdir,u8,version):
+    txdir.flat_to_tree(['r/.gitignore','    *.log','r/a/b/deep.txt','    deep','r/a/c.txt','    c'
+                        ,'r/keep.log','    kept','r/skip.log','    skipped','r/new.txt','    new'
+                        ,'r/l -> a/c.txt'])
+    def git(*a):
+        return run(['git','-C','r',*a],check=True,stdout=PIPE)
+    git('init','-q')
+    git('add','.gitignore','a','l')
+    git('add','-f','keep.log')
+    git('update-index','--skip-worktree','a/c.txt') #extended flags
+    git('update-index','--index-version',str(version))
+    g = txdir.GitIndex('r')
+    assert sorted(k for k,m in g.modes.items() if m != g.DIR) == ['.gitignore','a/b/deep.txt','a/c.txt','keep.log','l']
+    flat = list(txdir.tree_to_flat('r',**g.uses()))
+    assert flat == ['a/b/deep.txt','   deep','a/c.txt','   c','keep.log','   kept','l -> a/c.txt']
+    assert list(txdir.tree_to_view('r/a',**txdir.GitIndex('r/a').uses())) == list(txdir.tree_to_view('r/a'))
+    flat = list(txdir.tree_to_flat('r',with_content=False,**txdir.GitIndex('r',untracked=True).uses()))
+    assert 'new.txt' in flat and 'keep.log' in flat and 'skip.log' not in flat
+    os.remove('r/a/c.txt')
+    lines = []
+    txdir.main(print=lines.append,infile='r',l=True,g=True)
+    assert lines == ['a/b/deep.txt\n   deep\na/c.txt\nkeep.log\n   kept\nl -> a/c.txt']
+
+@pytest.mark.parametrize('ext',['.tar','.tar.gz','.zip'])
+def test_archive_source(tmpworkdir,u8,ext):
+    import tarfile
+    import zipfile
+    txdir.flat_to_tree(['pkg/a/aa.txt','    this is aa','pkg/b/c/','pkg/b/l -> ../a/aa.txt','pkg/z.txt','    z'])
+    with open('pkg/a/bin','wb') as f:
+        f.write(b'\x00\xff'*1000)
+    names = ['pkg/z.txt','pkg/b/l','pkg/b/c','pkg/b','pkg/a/bin','pkg/a/aa.txt','pkg/a','pkg'] #not sorted
+    if ext == '.zip':
+        with zipfile.ZipFile('p.zip','w') as z:
+            for n in names:
+                if os.path.islink(n):
+                    zi = zipfile.ZipInfo(n)
+                    zi.external_attr = 0o120777<<16
+                    z.writestr(zi,os.readlink(n))
+                else:
+                    z.write(n)
+    else:
+        with tarfile.open('p'+ext,'w'+ext.replace('.tar','').replace('.',':')) as t:
+            for n in names:
+                t.add(n,recursive=False)
+    for uses in [dict(with_binary=True),dict(with_content=False),dict(with_dot=True)]:
+        with txdir.ArchiveSource('p'+ext) as src:
+            assert list(txdir.tree_to_flat('/pkg',**uses,**src.uses())) == list(txdir.tree_to_flat('pkg',**uses))
+            assert list(txdir.tree_to_view('/pkg',**uses,**src.uses())) == list(txdir.tree_to_view('pkg',**uses))
+    assert txdir.TxDir.fromfs('p'+ext)('pkg').view() == txdir.TxDir.fromfs('pkg').view()
+    for ahead in (0,100):
+        with txdir.ArchiveSource('p'+ext,ahead=ahead) as src:
+            read = src.read
+            def bounded(pth):
+                assert ext == '.zip' or src.aheadsize <= ahead
+                return read(pth)
+            src.read = bounded
+            assert list(txdir.tree_to_view('/pkg',with_binary=True,**src.uses())) == list(txdir.tree_to_view('pkg',with_binary=True))
+    lines = []
+    txdir.main(print=lines.append,infile='p'+ext)
+    assert lines[0].startswith('└─ pkg/' if MID == '├' else '`- pkg/')
+    assert lines[0].endswith('z.txt\n         z')
+
+@pytest.mark.parametrize('ext',['.tar','.tar.gz','.zip'])
+def test_archive_sink(tmpworkdir,u8,ext):
+    d = fromcmds(['a/b/c,e','f'])
+    txdir.TxDir('x.txt',d('a/b'),('line 1\n','\n','line 3\n'))
+    txdir.TxDir('bin',d('a'),(repr(b64encode(b'\x00\xff'*100))+'\n',))
+    txdir.TxDir('empty',d('a'),())
+    txdir.TxDir('l',d('a'),'b/x.txt')
+    v,f = d.view(),d.flat()
+    for i,apply in enumerate([lambda sink: txdir.to_tree(v.splitlines(),**sink.uses())
+                             ,lambda sink: txdir.to_tree(f.splitlines(),**sink.uses())
+                             ,lambda sink: d.tree(**sink.uses(view=False))]):
+        with txdir.ArchiveSink(f'o{i}'+ext) as sink:
+            apply(sink)
+        assert os.listdir('.') == [f'o{i}'+ext]
+        with txdir.ArchiveSource(f'o{i}'+ext) as src:
+            assert src.read('a/bin') == b'\x00\xff'*100
+            assert src.targets['a/l'] == 'b/x.txt'
+            assert '\n'.join(txdir.tree_to_flat('/',with_binary=True,**src.uses()))+'\n' == f
+        os.remove(f'o{i}'+ext)
+    with open('v.txt','w') as fv:
+        fv.write(v)
+    txdir.main(infile='v.txt',outdir='o'+ext)
+    assert txdir.TxDir.fromfs('o'+ext,with_binary=True).view() == v
+    assert sorted(os.listdir('.')) == sorted(['o'+ext,'v.txt'])
+
+def test_delta(tmpworkdir,u8):
+    txdir.flat_to_tree(['old/same.txt','    same','old/mod.txt','    before','old/gone/x.txt','    x'
+                        ,'old/gone/y/','old/kind','    file','old/l -> same.txt','old/e.txt','    e'
+                        ,'old/empty/'])
+    txdir.flat_to_tree(['new/same.txt','    same','new/mod.txt','    after','new/kind/in.txt','    in'
+                        ,'new/l -> mod.txt','new/e.txt','new/empty/','new/add/deep/','new/add.txt','    add'])
+    with open('new/bin','wb') as f:
+        f.write(b'\x00\xff')
+    st = txdir.Stats()
+    delta = list(txdir.tree_delta('old','new',stats=st))
+    assert delta == ['add.txt','   add','add/deep/',"bin","   "+repr(b64encode(b'\x00\xff'))
+                     ,'e.txt ><','e.txt','gone/ ><','kind ><','kind/in.txt','   in'
+                     ,'l ><','l -> mod.txt','mod.txt','   after']
+    assert st.counters['hashed'] == 1 #same.txt, mod.txt differs in size
+    newflat = list(txdir.tree_to_flat('new',with_binary=True))
+    with txdir.with_cwd('old'):
+        txdir.to_tree(delta,fmt='flat',removals=True)
+    assert list(txdir.tree_to_flat('old',with_binary=True)) == newflat
+    assert list(txdir.tree_delta('old','new')) == []
+    #in memory, and from a view file
+    newtx = txdir.TxDir.fromfs('new',with_binary=True)
+    with open('new.txt','w') as f:
+        f.write(newtx.view())
+    t = fromview(txdir.TxDir.fromfs('old',with_binary=True).view())
+    assert list(txdir.tree_delta(t,'new.txt')) == []
+    assert list(txdir.tree_delta('new.txt',fromview(f'{END}{HOR} x.txt\n      x'))) == [
+        'add/ ><','add.txt ><','bin ><','e.txt ><','empty/ ><','kind/ ><','l ><','mod.txt ><','same.txt ><','x.txt','   x']
+    lines = []
+    txdir.main(print=lines.append,infile='new',D='old')
+    assert lines == []
+    txdir.main(infile='new.txt',outdir='old',D='new')
+    assert list(txdir.tree_to_flat('old',with_binary=True)) == newflat
+    rm = [f'{MID}{HOR} kind/ ><',f'{END}{HOR} same.txt ><']
+    errs = []
+    with txdir.with_cwd('old'):
+        txdir.view_to_tree(rm,eprint=errs.append) #not a delta: nothing removed
+    assert os.path.exists('old/same.txt') and os.path.exists('old/kind') and len(errs) == 2
+    with txdir.with_cwd('old'):
+        txdir.view_to_tree(rm,removals=True)
+    assert not os.path.exists('old/same.txt') and not os.path.exists('old/kind')
+    assert fromview(newtx.view()+f'\n{END}{HOR} add/ ><')('add')
+    with pytest.raises(FileNotFoundError):
+        txdir.TxDir.fromview(newtx.view()+f'\n{END}{HOR} add/ ><',removals=True)('add')
+    #removals stay below the target
+    txdir.flat_to_tree(['precious/keep.txt','    keep','t/in.txt','    in'])
+    os.symlink('../precious','t/out')
+    errs = []
+    with txdir.with_cwd('t'):
+        txdir.view_to_tree([f'{MID}{HOR} ../precious ><',f'{MID}{HOR} {os.path.abspath("precious")} ><'
+                            ,f'{END}{HOR} out/keep.txt ><'],removals=True,eprint=errs.append)
+        txdir.flat_to_tree(['../precious/ ><','out/keep.txt ><','in.txt ><'],removals=True,eprint=errs.append)
+    assert os.path.exists('precious/keep.txt') and len(errs) == 5
+    assert not os.path.exists('t/in.txt') and os.path.islink('t/out')
+    #a directory and a view of it are compared by the view lines
+    txdir.flat_to_tree(['p/a.txt','    a'])
+    with open('p/nonl.txt','w') as f:
+        f.write('trailing  \nno newline')
+    with open('p.txt','w') as f:
+        f.write('\n'.join(txdir.tree_to_view('p')))
+    assert list(txdir.tree_delta('p','p.txt')) == [] and list(txdir.tree_delta('p.txt','p')) == []
+    with open('p/a.txt','w') as f:
+        f.write('b\n')
+    assert list(txdir.tree_delta('p.txt','p')) == ['a.txt','   b']
+
+def test_verify(tmpworkdir,u8,monkeypatch):
+    txdir.flat_to_tree(['d/a.txt','    a','d/b/c.txt','    c','d/b/e/','d/l -> a.txt','d/empty.txt'])
+    with open('d/bin','wb') as f:
+        f.write(b'\x00\xff')
+    view = list(txdir.tree_to_view('d',with_binary=True))
+    flat = list(txdir.tree_to_flat('d',with_binary=True))
+    for lines in (view,flat):
+        assert txdir.verify(lines,'d') == []
+    with open('d/a.txt','w') as f:
+        f.write('A\n')
+    with open('d/b/c.txt','w') as f:
+        f.write('changed\n')
+    os.remove('d/l')
+    os.symlink('b','d/l')
+    os.mkdir('d/extra')
+    os.remove('d/bin')
+    st = txdir.Stats()
+    full = [('a.txt','content'),('b/c.txt','content'),('bin','missing'),('extra','extra'),('l','link')]
+    for lines in (view,flat):
+        assert txdir.verify(lines,'d',full=True,stats=st,jobs=2) == full
+        assert txdir.verify(lines,'d',jobs=1)[0] in full
+        assert len(txdir.verify(lines,'d')) == 1
+    assert st.counters['compared'] == 2*3
+    with open('v.txt','w') as f:
+        f.write('\n'.join(view))
+    lines = []
+    assert txdir.main(print=lines.append,infile='v.txt',outdir='d',K=True) == 1
+    assert lines == ['\n'.join(f'{p}: {r}' for p,r in full)]
+    assert txdir.main(print=lines.append,infile='d',outdir='d',k=True) == 0
+    import urllib.request
+    fetched = []
+    monkeypatch.setattr(urllib.request,'urlretrieve',lambda *a: fetched.append(a))
+    dwn = ['a.txt << http://example.invalid/a','gone.txt << http://example.invalid/g']
+    assert txdir.verify(dwn,'d',full=True,extras=False) == [('gone.txt','missing')]
+    assert txdir.verify([f'{END}{HOR} b << http://example.invalid/b'],'d',extras=False) == [('b','not a file')]
+    assert fetched == []
+
+def test_verify_text(tmpworkdir,u8):
+    os.makedirs('d/s')
+    for pth,data in (('a.txt',b'no end'),('b.txt',b'x  \ny\t\n'),('s/c.txt',b'\nfirst empty\n  x\n')
+                     ,('e.txt',b'\n\n'),('f.txt',b''),('bin',b'\x00\xff')):
+        with open('d/'+pth,'wb') as f:
+            f.write(data)
+    for fun in (txdir.tree_to_view,txdir.tree_to_flat):
+        assert txdir.verify(list(fun('d')),'d',full=True) == []
+        assert txdir.verify(list(fun('d',with_binary=True)),'d',full=True) == []
+    os.mkdir('o')
+    with txdir.with_cwd('o'):
+        txdir.flat_to_tree(list(txdir.tree_to_flat('../d')))
+    assert open('o/s/c.txt').read() == '\nfirst empty\n  x\n' #indented as the first non-empty line
+    assert txdir.main(infile='d',outdir='d',K=True) == 0
+    with open('d/b.txt','w') as f:
+        f.write('x\nY\n')
+    assert txdir.verify(list(txdir.tree_to_view('o')),'d') == [('b.txt','content')]
+
+def test_manifest(tmpworkdir,u8):
+    import hashlib
+    import tarfile
+    txdir.flat_to_tree(['d/a.txt','    a','d/b/c.txt','    c','d/b/e/','d/l -> a.txt','d/.h'])
+    with open('d/bin','wb') as f:
+        f.write(b'\x00\xff'*(txdir.HASHCHUNK//2+1))
+    def entry(pth,algo='sha256'):
+        with open(pth,'rb') as f:
+            b = f.read()
+        return f'{pth[2:]} {len(b)} {algo}:'+hashlib.new(algo,b).hexdigest()
+    st = txdir.Stats()
+    flat = list(txdir.tree_to_flat('d',digest='sha256',stats=st))
+    assert flat == [entry('d/a.txt'),entry('d/b/c.txt'),'b/e/',entry('d/bin'),'l -> a.txt']
+    assert st.counters['filedigest_bytes'] == 4+txdir.HASHCHUNK+2
+    assert list(txdir.tree_to_flat('d',digest='blake2b',jobs=2))[0] == entry('d/a.txt','blake2b')
+    view = list(txdir.tree_to_view('d',digest='sha256',with_dot=True,maxdepth=1))
+    assert view[0] == txdir.MID_END[0]+entry('d/.h')
+    assert view[2] == txdir.MID_END[0]+'b/' and not view[3].startswith(txdir.SUB_MID_END[0])
+    with tarfile.open('d.tar','w') as t:
+        t.add('d')
+    with txdir.ArchiveSource('d.tar') as src:
+        assert list(txdir.tree_to_flat('/d',digest='sha256',**src.uses())) == flat
+    #unchanged files are not read again
+    old = os.stat('d/a.txt').st_mtime-10
+    os.utime('d/a.txt',(old,old))
+    with txdir.DigestCache('cache.json') as cache:
+        assert list(txdir.tree_to_flat('d',digest='sha256',digestcache=cache)) == flat
+    with txdir.DigestCache('cache.json') as cache:
+        key = 'sha256 '+os.path.abspath('d/a.txt')
+        assert list(cache) == [key]
+        cache[key][3] = 'cached'
+        assert txdir.tree_to_flat('d',digest='sha256',digestcache=cache).__next__() == 'a.txt 2 sha256:cached'
+        os.utime('d/a.txt')
+        assert txdir.tree_to_flat('d',digest='sha256',digestcache=cache).__next__() == flat[0]
+    lines = []
+    txdir.main(print=lines.append,infile='d',outdir='o',l=True,H='sha256')
+    assert lines == ['\n'.join(flat)] and not os.path.exists('o')
+
+def test_since(tmpworkdir,u8):
+    from time import time,sleep
+    txdir.flat_to_tree(['d/a.txt','    a','d/b/x.txt','    x','d/c.txt','    c','d/l -> a.txt'
+                        ,'moved/m.txt','    m'])
+    snapshot = list(txdir.tree_to_view('d'))
+    sleep(0.2)
+    since = time()
+    sleep(0.2)
+    with open('d/a.txt','w') as f:
+        f.write('A\n')
+    os.mkdir('d/new')
+    os.rename('moved','d/b/moved') #old mtimes inside
+    os.remove('d/c.txt')
+    st = txdir.Stats()
+    assert list(txdir.tree_to_flat('d',since=since,stats=st)) == ['a.txt','   A','b/moved/m.txt','   m','new/']
+    assert st.counters['unchanged'] == 1 #b/x.txt not opened
+    view = list(txdir.tree_to_view('d',since=since))
+    assert view == [txdir.MID_END[0]+'a.txt','      A',txdir.MID_END[0]+'b/'
+                    ,txdir.SUB_MID_END[0]+txdir.MID_END[0]+'moved/'
+                    ,txdir.SUB_MID_END[0]+txdir.SUB_MID_END[0]+txdir.MID_END[1]+'m.txt'
+                    ,' '*12+'m'
+                    ,txdir.MID_END[1]+'new/']
+    os.mkdir('s')
+    with txdir.with_cwd('s'):
+        txdir.view_to_tree(snapshot)
+        txdir.view_to_tree(view)
+    assert os.path.exists('s/c.txt') #removals are not listed
+    with open('v','w') as f:
+        f.write('\n'.join(snapshot))
+    assert list(txdir.tree_delta('v','d')) == ['a.txt','   A','b/moved/m.txt','   m','c.txt '+txdir.RMV,'new/']
+    with txdir.with_cwd('s'):
+        txdir.flat_to_tree(txdir.tree_delta('../v','../d'),removals=True)
+    assert list(txdir.tree_to_view('s')) == list(txdir.tree_to_view('d'))
+    assert list(txdir.tree_to_view('d',since=time()+1)) == []
+    sleep(0.2)
+    lines = []
+    txdir.main(print=lines.append,infile='d',l=True,S='stamp')
+    assert lines == ['\n'.join(txdir.tree_to_flat('d'))]
+    sleep(0.2)
+    with open('d/b/x.txt','w') as f:
+        f.write('X\n')
+    lines = []
+    txdir.main(print=lines.append,infile='d',l=True,S='stamp')
+    assert lines == ['b/x.txt\n   X']
+
+@pytest.mark.parametrize('inotify',[True,False])
+def test_watch(tmpworkdir,u8,inotify):
+    from time import sleep
+    txdir.flat_to_tree(['d/a.txt','    a','d/b/x.txt','    x','d/c.txt','    c','d/l -> a.txt'
+                        ,'d/k','    kind','d/u/v/w.txt','    w'])
+    st = txdir.Stats()
+    with txdir.Watcher('d',debounce=0.05,poll=0.05,inotify=inotify,stats=st) as w:
+        assert (w.notify is not None) == (inotify and sys.platform.startswith('linux'))
+        assert w.viewlines() == list(txdir.tree_to_view('d'))
+        os.mkdir('c')
+        with txdir.with_cwd('c'):
+            txdir.flat_to_tree(list(txdir.tree_to_flat('../d')))
+        rescanned,read = st.counters['rescanned'],st.counters['filecontent']
+        sleep(0.05)
+        with open('d/a.txt','w') as f:
+            f.write('A\n')
+        os.makedirs('d/new/sub')
+        with open('d/new/sub/n.txt','w') as f:
+            f.write('n\n')
+        os.remove('d/c.txt')
+        os.remove('d/l')
+        os.symlink('b','d/l')
+        os.remove('d/k')
+        os.mkdir('d/k')
+        with open('d/k/in','w') as f:
+            f.write('in\n')
+        delta = [x for lines in w.changes(delta=True,timeout=0.5) for x in lines]
+        assert w.viewlines() == list(txdir.tree_to_view('d'))
+        assert st.counters['rescanned']-rescanned <= 4 #d, d/k, d/new, d/new/sub: not d/b, d/u, d/u/v
+        assert st.counters['filecontent']-read == 3 #a.txt, n.txt, in
+        assert sorted(x for x in delta if x.endswith(txdir.RMV)) == ['c.txt ><','k ><','l ><']
+        with txdir.with_cwd('c'):
+            txdir.to_tree(delta,fmt='flat',removals=True)
+        assert list(txdir.tree_to_flat('c')) == list(txdir.tree_to_flat('d'))
+        os.utime('d/b/x.txt')
+        assert list(w.changes(timeout=0.3)) == [] #same content
+    frames = []
+    def show(x):
+        frames.append(x)
+        if len(frames) == 1:
+            with open('d/b/x.txt','w') as f:
+                f.write('X\n')
+        else:
+            raise KeyboardInterrupt
+    flat = '\n'.join(txdir.tree_to_flat('d'))
+    assert txdir.main(print=show,infile='d',W=True) == 0
+    assert frames == [flat,'\f\nb/x.txt\n   X']
+
+def test_limits(tmpworkdir,u8):
+    import tarfile
+    txdir.flat_to_tree(['d/a.txt','    aaaa','d/b.txt','    '+'b'*20,'d/c.txt','    c','d/many/'])
+    for i in range(5):
+        with open(f'd/many/f{i}','w') as f:
+            f.write('x\n')
+    opened = []
+    def filecontent(pd,with_binary=False):
+        opened.append(os.path.basename(pd))
+        return txdir.filecontent(pd,with_binary)
+    st = txdir.Stats()
+    view = list(txdir.tree_to_view('d',maxfilebytes=10,maxbytes=7,maxentries=3,stats=st,filecontent=filecontent))
+    assert view == [txdir.MID_END[0]+'a.txt','      aaaa',txdir.MID_END[0]+'b.txt [21 bytes omitted]'
+                    ,txdir.MID_END[0]+'c.txt','      c',txdir.MID_END[1]+'./ [1 entries omitted]']
+    assert opened == ['a.txt','c.txt']
+    assert st.counters['omitted_files'] == 1 and st.counters['omitted_entries'] == 1
+    flat = list(txdir.tree_to_flat('d',maxbytes=6,maxentries=2))
+    assert flat == ['a.txt','   aaaa','b.txt [21 bytes omitted]','./ [2 entries omitted]']
+    assert list(txdir.tree_to_flat('d/many',maxentries=4)) == ['f0','   x','f1','   x','f2','   x','f3','   x','./ [1 entries omitted]']
+    assert list(txdir.tree_to_flat('d',maxentries=4))[-1] == 'many/ [1 entries omitted]'
+    with tarfile.open('d.tar','w') as t:
+        t.add('d')
+    with txdir.ArchiveSource('d.tar') as src:
+        assert list(txdir.tree_to_flat('/d',maxbytes=6,maxentries=2,**src.uses())) == flat
+    #applied, the entries are there, without the omitted content
+    for lines,o in ((view,'o'),(flat,'p')):
+        os.mkdir(o)
+        with txdir.with_cwd(o):
+            txdir.to_tree(lines)
+    assert list(txdir.tree_to_flat('o')) == ['a.txt','   aaaa','b.txt','c.txt','   c']
+    assert list(txdir.tree_to_flat('p')) == ['a.txt','   aaaa','b.txt']
+    lines = []
+    txdir.main(print=lines.append,infile='d',l=True,z=10,e=2)
+    assert lines == ['a.txt\n   aaaa\nb.txt [21 bytes omitted]\n./ [2 entries omitted]']
+    #entries that would not be listed are not counted, nor make a marker
+    txdir.flat_to_tree(['h/.x','    x','h/.y/','h/a.txt','    a','h/z.txt','    z','h/.gitignore','    z.txt'])
+    assert list(txdir.tree_to_flat('h',maxentries=1)) == ['a.txt','   a']
+    assert list(txdir.tree_to_flat('h',maxentries=1,with_dot=True))[-1] == './ [3 entries omitted]'
+    txdir.flat_to_tree(['h/b/'])
+    assert list(txdir.tree_to_view('h',maxentries=1,with_files=False)) == [txdir.MID_END[0]+'b/']
+    assert list(txdir.tree_to_view('h',maxentries=0))[-1] == txdir.MID_END[1]+'./ [2 entries omitted]'
+
+def test_ratelimit(tmpworkdir,u8,monkeypatch):
+    txdir.flat_to_tree(['d/a.txt','    '+'a'*49,'d/b.txt','    '+'b'*49,'d/c/d.txt','    '+'d'*49])
+    now,slept,dropped = [0.0],[],[]
+    def sleep(dt):
+        slept.append(dt)
+        now[0] += dt
+    monkeypatch.setattr(txdir,'dontneed',dropped.append)
+    rl = txdir.RateLimit(bytespersec=100,filespersec=1,burst=0,dontneed=True,clock=lambda:now[0],sleep=sleep)
+    view = list(txdir.tree_to_view('d',filecontent=rl.reading(txdir.filecontent)))
+    assert view == list(txdir.tree_to_view('d'))
+    assert slept == [1.0,1.0,1.0] #files per second, not bytes, are the limit
+    assert dropped == ['d/a.txt','d/b.txt','d/c/d.txt']
+    rl = txdir.RateLimit(bytespersec=100,burst=0.5,clock=lambda:now[0],sleep=sleep)
+    os.mkdir('o')
+    with txdir.with_cwd('o'):
+        txdir.to_tree(view,filewrite=rl.writing(txdir.filewrite))
+    assert slept[3:] == [pytest.approx(0.5)]*2 #the first 50 bytes from the burst
+    assert list(txdir.tree_to_view('o')) == view
+    big = 'x'*80+'\n'
+    with open('d/big.txt','w') as f:
+        f.writelines([big]*(txdir.MMAPSIZE//len(big)+1))
+    rl = txdir.RateLimit(dontneed=True)
+    res = rl.reading(txdir.filecontent)('d/big.txt')
+    assert isinstance(res,txdir.MappedLines) and dropped[3:] == []
+    assert sum(1 for _ in res.rstripped()) == txdir.MMAPSIZE//len(big)+1 and dropped[3:] == ['d/big.txt']
+    assert txdir.main(infile='d',outdir='p',r=10**9,R=1e6) == 0
+    assert list(txdir.tree_to_view('p')) == list(txdir.tree_to_view('d'))
+    assert txdir.main(infile='d',outdir='q',r=10**9,l=True,S='0') == 0
+    assert list(txdir.tree_to_view('q')) == list(txdir.tree_to_view('d'))
+
+def test_batch(tmpworkdir,u8,monkeypatch):
+    txdir.flat_to_tree(['d/a.txt','    a','d/e/b.txt','    b'])
+    lines,report = [],[]
+    jobs = ['["d","-l"]\n','\n','{"infile":"d","a":true,"z":"1"}\n',['d','o'],{'infile':'d','H':'sha256','C':'dc'}
+            ,'["-Z"]\n','{"bogus":1}\n','["d","-B","j"]\n','[1\n']
+    assert txdir.batch(jobs,print=lines.append,report=report.append,stdin=False) == 4
+    status = [json.loads(x) for x in report]
+    assert [x['job'] for x in status] == [1,3,4,5,6,7,8,9]
+    assert [x['ret'] for x in status] == [0,0,0,0,2,1,1,1]
+    assert [x.get('error','')[:10] for x in status[4:]] == ['invalid ar','ValueError','ValueError','JSONDecode']
+    flat = '\n'.join(txdir.tree_to_flat('d'))
+    chars = txdir._tree_chars()
+    txdir.set_ascii()
+    ascii = '\n'.join(txdir.tree_to_view('d',maxfilebytes=1))
+    txdir.set_tree_chars(**chars)
+    assert lines[:2] == [flat,ascii]
+    assert txdir._tree_chars() == chars #-a of job 3 only
+    assert list(txdir.tree_to_view('o')) == list(txdir.tree_to_view('d'))
+    assert os.path.exists('dc') and len(lines) == 3 #saved by batch
+    pooled,report2 = [],[]
+    assert txdir.batch(jobs,2,print=pooled.append,report=report2.append,stdin=False) == 4
+    assert pooled == lines and [json.loads(x)['ret'] for x in report2] == [x['ret'] for x in status]
+    with open('jobs','w') as f:
+        f.write('["d","-l"]\n["d","-n"]\n')
+    assert txdir.main(print=lines.append,B='jobs') == 0
+    assert lines[3:] == [flat,'\n'.join(txdir.tree_to_view('d',with_content=False))]
+    #low priority once per process, for the batch, not per job
+    niced,dropped,report = [],[],[]
+    monkeypatch.setattr(os,'nice',niced.append)
+    monkeypatch.setattr(txdir,'dontneed',dropped.append)
+    monkeypatch.setattr(txdir,'_niced',[])
+    assert txdir.batch([['d'],['d','-q'],['d']],print=lambda x:None,report=report.append,lowpriority=True) == 1
+    assert 'ValueError: -q' in report[1] and niced == [10] and len(dropped) == 4
+    #the digests of pooled jobs go to one cache, saved by the parent
+    for i in range(3):
+        txdir.flat_to_tree([f's{i}/x.txt',f'    {i}'])
+        os.utime(f's{i}/x.txt',(0,0))
+    assert txdir.batch([['s0','-H','sha256','-C','dc2']],print=lambda x:None,report=lambda x:None) == 0
+    assert txdir.batch([[f's{i}','-H','sha256','-C','dc2'] for i in (1,2)],2,print=lambda x:None,report=lambda x:None) == 0
+    assert sorted(x.split('/')[-2] for x in json.load(open('dc2'))) == ['s0','s1','s2']
+
+def importtime(*cmd):
+    r = sprun([sys.executable,'-X','importtime']+list(cmd),cwd=here,stdout=PIPE,stderr=PIPE)
+    assert r.returncode == 0
+    mods = {}
+    for ln in r.stderr.decode('utf-8').splitlines():
+        if ln.startswith('import time:') and '|' in ln:
+            selfus,cumus,mod = ln[12:].split('|')
+            if selfus.strip().isdigit():
+                mods[mod.strip()] = (int(selfus),int(cumus))
+    return mods
+
+heavy = ['pathspec','urllib.request','http.client','email','ssl','asyncio'
+         ,'concurrent.futures','tempfile','json','base64','hashlib','mmap','argparse']
+
+def test_importtime():
+    mods = importtime('-c','import txdir')
+    assert 'txdir' in mods
+    assert not [x for x in heavy if x in mods] #modules, not time: CI machines vary
+    mods = importtime('txdir.py','-c','a/b')
+    assert not [x for x in heavy[:-1] if x in mods]
+
 
 # vim: ts=4 sw=4 sts=4 et noai nocin nosi inde=
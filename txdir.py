@@ -3,15 +3,14 @@
 import sys
 import os
 import re
-import argparse
-import codecs
-from functools import partial
+from time import perf_counter, time
+from itertools import islice, chain
+from functools import partial, lru_cache
 import contextlib
+import struct
 from threading import RLock
-from urllib import request
-from tempfile import NamedTemporaryFile
-from base64 import b64encode, b64decode
-import pathspec
+#Heavier modules are imported where needed, to keep the startup fast:
+#check with `make importtime`.
 
 #also in README.rst
 __version__ = "2.0.2"
@@ -24,6 +23,8 @@ VER = '│'
 LNKL = '<-'
 LNKR = '->'
 DWN = '<<'
+RMV = '><' #entry to remove, in deltas
+OMITTED = ' [{} {} omitted]' #appended for content left out by the limits, e.g. ' [5000 bytes omitted]'
 MID_END = ['├─ ','└─ ']
 SUB_MID_END = ['│  ', '   ']
 
@@ -35,6 +36,7 @@ def set_tree_chars(
         ,lnkl = '<-'
         ,lnkr = '->'
         ,dwn = '<<'
+        ,rmv = '><'
         ,mid_end = ['├─ ','└─ ']
         ,sub_mid_end = ['│  ', '   ']
 ): # pragma: no cover
@@ -45,6 +47,7 @@ def set_tree_chars(
     global LNKL
     global LNKR
     global DWN
+    global RMV
     global MID_END
     global SUB_MID_END
     MID         = mid
@@ -54,6 +57,7 @@ def set_tree_chars(
     LNKL        = lnkl
     LNKR        = lnkr
     DWN         = dwn
+    RMV         = rmv
     MID_END     = mid_end
     SUB_MID_END = sub_mid_end
 
@@ -86,6 +90,40 @@ islink = os.path.islink
 listdir = os.listdir
 readlink = os.readlink
 symlink = os.symlink
+getsize = os.path.getsize
+def filetimes(pth):
+    """``(mtime, ctime)`` of a file, link or directory, not following links"""
+    st = os.lstat(pth)
+    return st.st_mtime,st.st_ctime
+def remove(pth,root=None):
+    """
+    Remove a file, link or directory tree, if there.
+    With ``root``, only below ``root``, also after resolving the links of the parents;
+    else ``ValueError``.
+    """
+    if root is not None:
+        parent = os.path.realpath(dirname(os.path.abspath(pth)))
+        top = os.path.realpath(root)
+        if parent != top and not parent.startswith(top.rstrip(os.sep)+os.sep):
+            raise ValueError(f"{pth}: not below {root}")
+    if islink(pth) or isfile(pth):
+        os.remove(pth)
+    elif isdir(pth):
+        import shutil
+        shutil.rmtree(pth)
+
+def dontneed(pth):
+    """Drop the cached pages of a file read once, so that a scan does not evict the hot ones"""
+    try:
+        fd = os.open(pth,os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd,0,0,os.POSIX_FADV_DONTNEED)
+    except (AttributeError,OSError): #not on Windows, macOS
+        pass
+    finally:
+        os.close(fd)
 
 #helpers
 _cdlock = RLock()
@@ -99,10 +137,68 @@ def with_cwd(apth,cwd=cwd,cd=cd):
     finally:
         cd(prev_cwd)
         _cdlock.release()
+MMAPSIZE = 1<<20 #text files from this size on are read via mmap
+class MappedLines:
+    """
+    The lines of a large UTF-8 text file with ``\\n`` line ends,
+    sliced from a memory map while iterating, like ``readlines()``,
+    but without holding all of them in memory.
+    """
+    def __init__(self,pd,size):
+        self.pd = pd
+        self.size = size
+        self.done = None #called with pd after the last chunk
+    @staticmethod
+    def mappable(f,chunk=MMAPSIZE):
+        """Check a binary file: raise UnicodeDecodeError if not UTF-8, False if it has \\r"""
+        import mmap
+        import codecs
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            if mm.find(b'\r') >= 0:
+                return False
+            dec = codecs.getincrementaldecoder('utf-8')()
+            for i in range(0,len(mm),chunk):
+                dec.decode(mm[i:i+chunk])
+            dec.decode(b'',True)
+        return True
+    def _chunks(self,chunk=MMAPSIZE):
+        # decoded pieces of about chunk bytes, ending at a line end
+        import mmap
+        with open(self.pd,'rb') as f:
+            with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+                pos,size = 0,len(mm)
+                while pos < size:
+                    end = mm.rfind(b'\n',pos,pos+chunk)
+                    if end < 0:
+                        end = mm.find(b'\n',pos+chunk)
+                    end = size if end < 0 else end+1
+                    yield mm[pos:end].decode('utf-8')
+                    pos = end
+        if self.done:
+            self.done(self.pd)
+    def __iter__(self):
+        for c in self._chunks():
+            lns = c.split('\n')
+            last = lns.pop()
+            for ln in lns:
+                yield ln+'\n'
+            if last:
+                yield last
+    def rstripped(self):
+        """the lines without trailing white space"""
+        for c in self._chunks():
+            lns = c.split('\n')
+            if not lns[-1]:
+                lns.pop()
+            for ln in lns:
+                yield ln.rstrip()
 def filecontent(pd,with_binary=False):
     try:
         with open(pd, encoding='utf-8') as f:
-            return f.readlines()
+            size = os.fstat(f.fileno()).st_size
+            if size < MMAPSIZE or not MappedLines.mappable(f.buffer):
+                return f.readlines()
+        return MappedLines(pd,size)
     except UnicodeDecodeError:
         if with_binary:
             with open(pd, 'rb') as f:
@@ -125,7 +221,11 @@ def fileyield(pd,tpad
     if fcontent is None:
         return
     if isinstance(fcontent,bytes):
+        from base64 import b64encode
         yield tpad + repr(b64encode(fcontent)) #encloded in b''
+    elif isinstance(fcontent,MappedLines):
+        for tmpln in fcontent.rstripped():
+            yield tpad + tmpln if tmpln else ''
     else:
         for ln in fcontent:
             tmpln = ln.rstrip()
@@ -133,18 +233,62 @@ def fileyield(pd,tpad
                 yield tpad + tmpln
             else:
                 yield ''
+_fsremove = remove
+def _removal(entry,removals,remove,eprint):
+    """Remove the entry of a line ending in `` ><``, if ``removals`` and if it is below the target"""
+    pth = entry[:-len(RMV)].strip().rstrip('/')
+    if not removals:
+        eprint(pth+": not removed, removals are for deltas (removals=True, -D)")
+    elif not pth or pth.startswith('/') or os.path.isabs(pth) or '..' in pth.replace('\\','/').split('/'):
+        eprint(pth+": not removed, not below the target")
+    else:
+        try:
+            remove(pth)
+        except ValueError as err:
+            eprint(err)
 def fileput(efile,cntlns,filewrite=filewrite):
     if len(cntlns)==1 and cntlns[0].startswith("b'") and cntlns[0].rstrip().endswith("'"): # enclosed in b''
         #cntlns = [repr(b64encode(b'chk'))] #b'Y2hr'
+        from base64 import b64decode
         cntbytes = b64decode(cntlns[0].rstrip()[2:-1].encode()) #b'chk'
         filewrite(efile,cntbytes)
         return
     filewrite(efile,cntlns)
+HASHCHUNK = 1<<20 #bytes read at a time when hashing a file
+def filedigest(pd,algo='sha256',cache=None):
+    """
+    ``(size, hexdigest)`` of the bytes of file ``pd``.
+
+    :param algo: a ``hashlib`` algorithm name
+    :param cache: dict of earlier digests, reused while size, mtime and inode are the same
+    """
+    import hashlib
+    with open(pd,'rb') as f:
+        st = os.fstat(f.fileno())
+        if cache is not None:
+            key = algo+' '+os.path.abspath(pd)
+            stamp = [st.st_size,st.st_mtime_ns,st.st_ino]
+            hit = cache.get(key)
+            if hit and hit[:3] == stamp:
+                return st.st_size,hit[3]
+        h = hashlib.new(algo)
+        buf = bytearray(HASHCHUNK)
+        view = memoryview(buf)
+        n = f.readinto(buf)
+        while n:
+            h.update(view[:n])
+            n = f.readinto(buf)
+    hexd = h.hexdigest()
+    #a file changed within the mtime granularity after hashing would look unchanged
+    if cache is not None and time()-st.st_mtime > 2:
+        cache[key] = stamp+[hexd]
+    return st.st_size,hexd
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 @contextlib.contextmanager
 def temp():
+  from tempfile import NamedTemporaryFile
   try:
     f = NamedTemporaryFile(delete=False)
     tmp_name = f.name
@@ -153,6 +297,7 @@ def temp():
   finally:
     os.unlink(tmp_name)
 def urlretrieve(url,tofile,filewrite=filewrite,filecontent=filecontent,eprint=eprint):
+    from urllib import request
     with temp() as f:
         try:
             request.urlretrieve(url, f)
@@ -206,18 +351,688 @@ class GitIgnore:
         gidir = up_dir(lambda x:name(x)=='.gitignore',start=start,listdir=listdir,up=up)
         self.name = name
         if gidir:
+            import pathspec
             self.spec = pathspec.PathSpec.from_lines('gitwildmatch',filecontent(normjoin(gidir,'.gitignore')))
     def __call__(self,file):
         return self.spec and self.spec.match_file(self.name(file))
+class _Listing:
+    """Directory entries by path relative to a root, for sources other than the file system"""
+    DIR,LINK,GITLINK = 0o040000,0o120000,0o160000
+    def __init__(self):
+        self.modes = {'':self.DIR}
+        self.children = {'':[]}
+    def _add(self,pth,mode):
+        if pth in self.modes: #again, or made as parent before
+            self.modes[pth] = mode
+            return
+        self.modes[pth] = mode
+        d,_,n = pth.rpartition('/')
+        c = self.children.get(d)
+        if c is None:
+            c = self.children[d] = []
+            self._add(d,self.DIR)
+        c.append(n)
+class GitIndex(_Listing):
+    """
+    The files tracked by git in the work tree containing ``start``,
+    read from ``.git/index`` (versions 2 to 4), without running git.
+    ``uses()`` returns the ``uses`` of ``tree_to_view`` and ``tree_to_flat``,
+    which list and classify the tracked entries from the index instead of the file system.
+    Tracked files are listed even if ``.gitignore`` matches them, as in git.
+
+    :param start: directory in a git work tree, the rootpath of the scan
+    :param untracked: also list the untracked files not ignored by ``.gitignore``
+
+    """
+    def __init__(self,start,untracked=False):
+        super().__init__()
+        self.start = normjoin(start)
+        start = os.path.abspath(start)
+        self.worktree = up_dir(lambda x:x=='.git',start=start)
+        if not self.worktree:
+            raise FileNotFoundError(f"no git work tree at {start}")
+        gitdir = normjoin(self.worktree,'.git')
+        if isfile(gitdir): #gitdir: path, for worktrees and submodules
+            with open(gitdir,encoding='utf-8') as f:
+                gitdir = normjoin(self.worktree,f.read().split(':',1)[1].strip())
+        with open(normjoin(gitdir,'index'),'rb') as f:
+            data = f.read()
+        self.sizes = {}
+        for pth,mode,size in self.entries(data,self._hashsize(gitdir)):
+            if pth not in self.modes: #once, if in conflict
+                self._add(pth,mode)
+                self.sizes[pth] = size
+        sub = relpath(start,self.worktree)
+        self.sub = '' if sub == '.' else sub
+        self.untracked = GitIgnore(start=start) if untracked else None
+        self._keys = {}
+    @staticmethod
+    def _hashsize(gitdir):
+        try:
+            with open(normjoin(gitdir,'config'),encoding='utf-8') as f:
+                if re.search(r'objectformat\s*=\s*sha256',f.read(),re.I):
+                    return 32
+        except OSError:
+            pass
+        return 20
+    @staticmethod
+    def entries(data,hashsize=20):
+        """Yield (path, mode, size) of the entries of an index file's content"""
+        sig,version,n = struct.unpack_from('>4sII',data)
+        if sig != b'DIRC' or version not in (2,3,4):
+            raise ValueError(f"unsupported git index {sig} {version}")
+        off,pth = 12,b''
+        stat = struct.Struct('>24xI8xI')
+        flagsat = 40+hashsize
+        for _ in range(n):
+            mode,size = stat.unpack_from(data,off)
+            flags, = struct.unpack_from('>H',data,off+flagsat)
+            namestart = off+flagsat+2
+            if version >= 3 and flags & 0x4000:
+                namestart += 2
+            nameend = data.index(b'\0',namestart)
+            if version == 4: #varint of bytes to strip from the previous path, then the rest
+                b = data[namestart]
+                strip = b&0x7f
+                namestart += 1
+                while b & 0x80:
+                    b = data[namestart]
+                    strip = ((strip+1)<<7)|(b&0x7f)
+                    namestart += 1
+                nameend = data.index(b'\0',namestart)
+                pth = (pth[:len(pth)-strip] if strip else pth)+data[namestart:nameend]
+                off = nameend+1
+            else:
+                pth = data[namestart:nameend]
+                off += (nameend-off+8)&~7
+            yield pth.decode('utf-8','surrogateescape').rstrip('/'),mode,size
+        if data[off:off+4] == b'link':
+            raise ValueError("split git index is not supported")
+    def key(self,p):
+        """path in the work tree of a path built from ``start``"""
+        k = self._keys.get(p)
+        if k is None:
+            q = p.replace('\\','/')
+            if self.start == '.':
+                rel = '' if q == '.' else q
+            elif q == self.start:
+                rel = ''
+            elif q.startswith(self.start+'/'):
+                rel = q[len(self.start)+1:]
+            else:
+                rel = relpath(q,self.start)
+            k = self._keys[p] = self.sub+'/'+rel if self.sub and rel else self.sub or rel
+        return k
+    def uses(self):
+        """The uses for scanning ``start`` with the index"""
+        modes,children,key,untracked = self.modes,self.children,self.key,self.untracked
+        def _listdir(p):
+            k = key(p)
+            ds = children.get(k)
+            if untracked:
+                try:
+                    more = [x for x in listdir(p) if x != '.git']
+                except OSError:
+                    more = []
+                ds = list(dict.fromkeys((ds or [])+more))
+            return ds or []
+        def _isdir(p):
+            m = modes.get(key(p))
+            return isdir(p) if m is None else m in (self.DIR,self.GITLINK)
+        def _islink(p):
+            m = modes.get(key(p))
+            return islink(p) if m is None else m == self.LINK
+        def _filecontent(p,with_binary=False):
+            try:
+                return filecontent(p,with_binary=with_binary)
+            except FileNotFoundError: #deleted, but still tracked
+                return None
+        def _gitignore(p):
+            return key(p) not in modes and bool(untracked and untracked(p))
+        return dict(listdir=_listdir,isdir=_isdir,islink=_islink
+                    ,filecontent=_filecontent,gitignore=_gitignore)
+ARCHIVES = ('.tar','.tar.gz','.tgz','.tar.bz2','.tbz2','.tar.xz','.txz','.zip','.whl')
+def isarchive(pth):
+    return pth.lower().endswith(ARCHIVES)
+class ArchiveSource(_Listing):
+    """
+    A tar or zip file as directory with root ``/``.
+    The directory index is built once from the member list.
+    ``uses()`` returns the ``uses`` of ``tree_to_view`` and ``tree_to_flat``::
+
+        with ArchiveSource('release.tar.gz') as src:
+            lines = list(tree_to_view('/',**src.uses()))
+
+    Member content is read when needed.
+    Compressed tar files are read forward only, in archive order:
+    members passed on the way are kept until asked for, up to ``ahead`` bytes;
+    the others are read again when asked for, by seeking back.
+
+    :param path: archive file, see ``ARCHIVES``
+    :param ahead: bytes of members kept at most
+
+    """
+    AHEAD = 64<<20
+    def __init__(self,path,ahead=AHEAD):
+        super().__init__()
+        self.members,self.targets,self.times = {},{},{}
+        self.zip = self.tar = None
+        if path.lower().endswith(('.zip','.whl')):
+            import zipfile
+            import stat
+            self.zip = zipfile.ZipFile(path)
+            from time import mktime
+            for zi in self.zip.infolist():
+                pth = self.key(zi.filename)
+                mode = zi.external_attr >> 16
+                if not pth:
+                    continue
+                self.times[pth] = mktime(zi.date_time+(0,0,-1))
+                if zi.is_dir():
+                    self._add(pth,self.DIR)
+                    continue
+                if stat.S_ISLNK(mode):
+                    self.targets[pth] = self.zip.read(zi).decode('utf-8')
+                    self._add(pth,self.LINK)
+                else:
+                    self._add(pth,mode or 0o100644)
+                self.members[pth] = zi
+        else:
+            import tarfile
+            self.tar = tarfile.open(path)
+            self.forward = not path.lower().endswith('.tar')
+            self.order,self.ahead,self.pos = [],{},0
+            self.maxahead,self.aheadsize = ahead,0
+            for m in self.tar:
+                pth = self.key(m.name)
+                if not pth:
+                    continue
+                self.times[pth] = m.mtime
+                if m.isdir():
+                    self._add(pth,self.DIR)
+                    continue
+                if m.issym():
+                    self.targets[pth] = m.linkname
+                    self._add(pth,self.LINK)
+                elif m.isfile() or m.islnk():
+                    self._add(pth,0o100000|m.mode)
+                else: #devices, fifos
+                    continue
+                self.members[pth] = m
+                self.order.append((pth,m))
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        self.close()
+    def close(self):
+        (self.zip or self.tar).close()
+    @staticmethod
+    def key(p):
+        """member path of a path below ``/``"""
+        return normjoin('/',p.replace('\\','/')).strip('/')
+    def read(self,pth):
+        """the bytes of a file member"""
+        m = self.members[pth]
+        if self.zip:
+            return self.zip.read(m)
+        if not self.forward:
+            return self.tar.extractfile(m).read()
+        b = self.ahead.pop(pth,None)
+        if b is not None:
+            self.aheadsize -= len(b)
+            return b
+        while self.pos < len(self.order):
+            xp,x = self.order[self.pos]
+            self.pos += 1
+            if x is m:
+                break
+            if x.isfile() and self.aheadsize+x.size <= self.maxahead:
+                b = self.ahead[xp] = self.tar.extractfile(x).read()
+                self.aheadsize += len(b)
+        return self.tar.extractfile(m).read() #next, or passed over: seek back
+    def uses(self):
+        """The uses for scanning ``/`` or a directory below it"""
+        import io
+        modes,key = self.modes,self.key
+        def _listdir(p):
+            k = key(p)
+            if modes.get(k) != self.DIR:
+                raise FileNotFoundError(p)
+            return self.children.get(k,[])
+        def _isdir(p):
+            return modes.get(key(p)) == self.DIR
+        def _islink(p):
+            return modes.get(key(p)) == self.LINK
+        def _readlink(p):
+            return self.targets[key(p)]
+        def _filecontent(p,with_binary=False):
+            b = self.read(key(p))
+            try:
+                return io.TextIOWrapper(io.BytesIO(b),encoding='utf-8').readlines()
+            except UnicodeDecodeError:
+                if with_binary:
+                    return b
+        def _filedigest(p,algo='sha256',cache=None):
+            import hashlib
+            b = self.read(key(p))
+            return len(b),hashlib.new(algo,b).hexdigest()
+        def _filetimes(p):
+            t = self.times.get(key(p),0) #0: parent only implied by its members
+            return t,t
+        def _filesize(p):
+            m = self.members[key(p)]
+            return m.file_size if self.zip else m.size
+        return dict(listdir=_listdir,isdir=_isdir,islink=_islink
+                    ,readlink=_readlink,filecontent=_filecontent,filedigest=_filedigest
+                    ,filetimes=_filetimes,filesize=_filesize)
+class ArchiveSink:
+    """
+    Write a tar or zip file instead of a directory.
+    ``uses()`` returns the ``uses`` of ``view_to_tree``, ``flat_to_tree``, ``to_tree``
+    and ``TxDir.tree`` (``view=False``), which then add the entries as members,
+    without a file on disk::
+
+        with ArchiveSink('release.tar.gz') as sink:
+            to_tree(lines,**sink.uses())
+
+    The member times are ``SOURCE_DATE_EPOCH``, if set, else now.
+
+    :param path: archive file to write, see ``ARCHIVES``
+
+    """
+    def __init__(self,path):
+        from time import time
+        self.mtime = int(os.environ.get('SOURCE_DATE_EPOCH',time()))
+        self.current = ''
+        self.made = set() #paths added
+        if path.lower().endswith(('.zip','.whl')):
+            import zipfile
+            self.zip = zipfile.ZipFile(path,'w',zipfile.ZIP_DEFLATED)
+            self.tar = None
+        else:
+            import tarfile
+            self.zip = None
+            comp = path.lower().rsplit('.',1)[-1]
+            comp = {'tgz':'gz','tbz2':'bz2','txz':'xz'}.get(comp,comp)
+            self.tar = tarfile.open(path,'w:'+comp if comp in ('gz','bz2','xz') else 'w')
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        self.close()
+    def close(self):
+        (self.zip or self.tar).close()
+    def key(self,p):
+        """member path of a path relative to the current directory"""
+        return normjoin('/',self.current,p.replace('\\','/')).strip('/')
+    def _member(self,pth,mode,data=b'',linkname=None):
+        perm = {_Listing.DIR:0o755,_Listing.LINK:0o777}.get(mode,0o644)
+        if linkname:
+            data = linkname.encode('utf-8')
+        if self.zip:
+            import zipfile
+            from time import gmtime
+            zi = zipfile.ZipInfo(pth+'/' if mode == _Listing.DIR else pth
+                                 ,date_time=gmtime(max(self.mtime,315532800))[:6]) #zip starts 1980
+            zi.external_attr = (mode|perm)<<16
+            if mode != _Listing.DIR:
+                zi.compress_type = zipfile.ZIP_DEFLATED
+            self.zip.writestr(zi,data)
+        else:
+            import io
+            import tarfile
+            ti = tarfile.TarInfo(pth)
+            ti.mtime,ti.mode = self.mtime,perm
+            if mode == _Listing.DIR:
+                ti.type = tarfile.DIRTYPE
+            elif mode == _Listing.LINK:
+                ti.type,ti.linkname = tarfile.SYMTYPE,linkname
+            else:
+                ti.size = len(data)
+            self.tar.addfile(ti,io.BytesIO(data) if ti.size else None)
+        self.made.add(pth)
+    def _mkdirs(self,pth):
+        parts = pth.split('/')
+        for i in range(1,len(parts)+1):
+            d = '/'.join(parts[:i])
+            if d and d not in self.made:
+                self._member(d,_Listing.DIR)
+    def mkdir(self,apath):
+        self._mkdirs(self.key(apath))
+    def filewrite(self,apath,cntlns):
+        pth = self.key(apath)
+        self._mkdirs(dirname(pth))
+        data = cntlns if isinstance(cntlns,bytes) else ''.join(cntlns).encode('utf-8')
+        self._member(pth,0o100000,data)
+    def symlink(self,lnk,apath):
+        pth = self.key(apath)
+        self._mkdirs(dirname(pth))
+        self._member(pth,_Listing.LINK,linkname=lnk)
+    def exists(self,apath):
+        return self.key(apath) in self.made
+    def remove(self,apath):
+        pass #nothing to remove in a new archive
+    @contextlib.contextmanager
+    def withcwd(self,apath):
+        prev = self.current
+        self.current = self.key(apath)
+        try:
+            yield
+        finally:
+            self.current = prev
+    def uses(self,view=True):
+        u = dict(mkdir=self.mkdir,symlink=self.symlink,filewrite=self.filewrite
+                 ,exists=self.exists,remove=self.remove)
+        if view:
+            u.update(cwd=lambda:'/'+self.current,withcwd=self.withcwd)
+        return u
+class _Rooted:
+    """
+    The ``uses`` of ``view_to_tree`` and ``flat_to_tree`` below ``root``,
+    with a current directory of its own, like ``ArchiveSink``,
+    for threads that must not ``os.chdir`` the process.
+    """
+    def __init__(self,root,current=''):
+        self.root = root
+        self.current = current
+    def path(self,p=''):
+        return normjoin(self.root,self.current,p)
+    @contextlib.contextmanager
+    def withcwd(self,apath):
+        prev = self.current
+        self.current = normjoin(self.current,apath)
+        try:
+            yield
+        finally:
+            self.current = prev
+    def uses(self,view=True):
+        u = dict(mkdir=lambda p: mkdir(self.path(p))
+                 ,symlink=lambda lnk,p: symlink(lnk,self.path(p))
+                 ,filewrite=lambda p,cntlns: filewrite(self.path(p),cntlns)
+                 ,exists=lambda p: exists(self.path(p))
+                 ,remove=lambda p: remove(self.path(p),root=self.root))
+        if view:
+            u.update(cwd=self.path,withcwd=self.withcwd)
+        return u
+def _size(res):
+    if isinstance(res,bytes):
+        return len(res)
+    if isinstance(res,MappedLines):
+        return res.size
+    try:
+        return sum(len(x.encode()) for x in res)
+    except Exception:
+        return 0
+class Stats:
+    """
+    Counters and timings of a run.
+
+    Pass an instance as ``stats`` to the scan and apply functions.
+    The ``uses`` functions are wrapped to count calls, bytes and time.
+
+    >>> s = Stats()
+    >>> s.count('x')
+    >>> s.report()['counters']
+    {'x': 1}
+
+    """
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+    def count(self,key,n=1):
+        self.counters[key] = self.counters.get(key,0)+n
+    def time(self,key,dt):
+        self.timings[key] = self.timings.get(key,0.0)+dt
+    @contextlib.contextmanager
+    def phase(self,key):
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.time(key,perf_counter()-t0)
+    def wrap(self,fun,key,size=None):
+        """Count calls of fun under key, and bytes of size(args,result) under key_bytes"""
+        if getattr(fun,'_stats',None) is self:
+            return fun
+        def wrapped(*args,**kwargs):
+            t0 = perf_counter()
+            try:
+                res = fun(*args,**kwargs)
+            finally:
+                self.time(key,perf_counter()-t0)
+            self.count(key)
+            if size:
+                self.count(key+'_bytes',size(args,res))
+            return res
+        wrapped._stats = self
+        return wrapped
+    def merge(self,report):
+        for k,v in report['counters'].items():
+            self.count(k,v)
+        for k,v in report['timings'].items():
+            self.time(k,v)
+    def report(self):
+        return {'counters':dict(sorted(self.counters.items()))
+               ,'timings':{k:round(v,6) for k,v in sorted(self.timings.items())}}
+    def json(self):
+        import json
+        return json.dumps(self.report(),indent=1)
 
 #functions
 MAXDEPTH = 30
+class RateLimit:
+    """
+    A budget of bytes and files per second for reading and writing,
+    shared by the threads of a run.
+    The wrapped functions wait before each file until the budget allows it::
+
+        rl = RateLimit(bytespersec=10<<20,filespersec=500,dontneed=True)
+        lines = list(tree_to_view('.',filecontent=rl.reading(filecontent)))
+        to_tree(lines,filewrite=rl.writing(filewrite))
+
+    :param bytespersec: None for no limit
+    :param filespersec: None for no limit
+    :param dontneed: drop the pages of the files read from the page cache, see ``dontneed``
+    :param burst: seconds of the budget that can be used at once
+    :param stats: a ``Stats`` instance, to time the waits as ``throttle``
+
+    """
+    def __init__(self,bytespersec=None,filespersec=None,dontneed=False,burst=0.1,stats=None
+                 ,clock=perf_counter,sleep=None):
+        from time import sleep as _sleep
+        self.rates = (bytespersec,filespersec)
+        self.dontneed,self.burst,self.stats = dontneed,burst,stats
+        self.clock,self.sleep = clock,sleep or _sleep
+        self.tat = [clock()-burst]*2 #when each budget is used up, at the rates
+        self.lock = RLock()
+    def wait(self,nbytes,nfiles=1):
+        """Reserve ``nbytes`` and ``nfiles`` of the budget, sleeping until they are due"""
+        delay = 0
+        with self.lock:
+            now = self.clock()
+            for i,(n,rate) in enumerate(zip((nbytes,nfiles),self.rates)):
+                if rate:
+                    self.tat[i] = max(self.tat[i],now-self.burst)+n/rate
+                    delay = max(delay,self.tat[i]-now)
+        if delay > 0.01: #fewer, longer sleeps: the average stays the same
+            t0 = self.clock()
+            self.sleep(delay)
+            if self.stats:
+                self.stats.time('throttle',self.clock()-t0)
+    def reading(self,fun,size=getsize,fs=True):
+        """
+        Wrap a function reading the file at its first argument,
+        like ``filecontent``, ``filedigest`` or ``filecopy``.
+
+        :param size: of the file, charged before reading it
+        :param fs: the paths are in the file system, for ``dontneed``
+        """
+        def read(pth,*args,**kwargs):
+            try:
+                n = size(pth)
+            except (OSError,KeyError):
+                n = 0
+            self.wait(n)
+            res = fun(pth,*args,**kwargs)
+            if self.dontneed and fs:
+                if isinstance(res,MappedLines): #read while iterating
+                    res.done = dontneed
+                else:
+                    dontneed(pth)
+            return res
+        return read
+    def writing(self,fun):
+        """Wrap a function writing its second argument to the file at its first, like ``filewrite``"""
+        def write(pth,cntlns,*args,**kwargs):
+            self.wait(_size(cntlns))
+            return fun(pth,cntlns,*args,**kwargs)
+        return write
+_fsuses = (isdir,normjoin,islink,listdir,filecontent,readlink,dirname)
+def _tree_chars():
+    return dict(mid=MID,end=END,hor=HOR,ver=VER,lnkl=LNKL,lnkr=LNKR,dwn=DWN,rmv=RMV
+                ,mid_end=MID_END,sub_mid_end=SUB_MID_END)
+def _shard(fun,chars,pd,kwargs):
+    set_tree_chars(**chars)
+    st = Stats() if kwargs.pop('stats') else None
+    lines = list(fun(pd,stats=st,**kwargs))
+    if not lines and fun is tree_to_flat:
+        lines = ['/'.join(kwargs['prefix'])+'/']
+    return lines, st and st.report()
+def _sharded(fun,tree,rootdir,prefix,jobs,stats,kwargs):
+    """
+    Walk the top levels with ``tree`` and render the subdirectories
+    below ``sharddepth`` in a process pool.
+    The shards are yielded in order, so the output equals the serial one.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    chars = _tree_chars()
+    kwargs['stats'] = bool(stats)
+    with ProcessPoolExecutor(jobs) as ex:
+        def shard(pd,subprefix):
+            return ex.submit(_shard,fun,chars,pd,dict(kwargs,prefix=subprefix))
+        for x in list(tree(rootdir,prefix,shard)):
+            if isinstance(x,str):
+                yield x
+            else:
+                lines,report = x.result()
+                if stats and report:
+                    stats.merge(report)
+                yield from lines
+class DigestCache(dict):
+    """
+    The ``cache`` of ``filedigest``, kept in the JSON file ``pth`` across runs.
+
+    >>> with DigestCache('.txdir-digests') as cache: # doctest: +SKIP
+    ...     lines = list(tree_to_flat('.',digest='sha256',digestcache=cache))
+
+    """
+    def __init__(self,pth=None):
+        super().__init__()
+        self.pth = pth
+        self.new = {} #set since loaded or saved
+        if pth:
+            import json
+            try:
+                with open(pth,encoding='utf-8') as f:
+                    self.update(json.load(f))
+            except (OSError,ValueError):
+                pass
+    def __setitem__(self,key,value):
+        super().__setitem__(key,value)
+        self.new[key] = value
+    def save(self):
+        import json
+        tmp = self.pth+'.tmp'
+        with open(tmp,'w',encoding='utf-8') as f:
+            json.dump(self,f)
+        os.replace(tmp,self.pth)
+        self.new = {}
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        if self.pth and not exc[0]:
+            self.save()
+HASHWINDOW = 256 #files hashed ahead of the output
+def _digested(items,digest,filedigest,stats):
+    """
+    Replace the ``(line,pd)`` file entries of ``items`` with ``line size algo:hex``.
+    The files are hashed in a thread pool, the lines are yielded in order.
+    Other items, like the shards of ``_sharded``, are passed through.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+    def hashed(line,pd):
+        try:
+            size,hexd = filedigest(pd,digest)
+        except OSError: #gone or unreadable
+            return line,None
+        return line+' '+str(size)+' '+digest+':'+hexd,size
+    pending = deque()
+    nhash = 0
+    ex = ThreadPoolExecutor()
+    try:
+        def out():
+            kind,x = pending.popleft()
+            if kind:
+                line,size = x.result()
+                if stats and size is not None:
+                    stats.count('filedigest')
+                    stats.count('filedigest_bytes',size)
+                return line
+            return x
+        for x in items:
+            if isinstance(x,tuple):
+                pending.append((True,ex.submit(hashed,*x)))
+                nhash += 1
+            else:
+                pending.append((False,x))
+            while nhash > HASHWINDOW:
+                nhash -= pending[0][0]
+                yield out()
+        while pending:
+            yield out()
+    finally:
+        for kind,x in pending:
+            if kind:
+                x.cancel()
+        ex.shutdown()
+def _budget(maxfilebytes,maxbytes,filesize,stats):
+    """
+    Returns a function of a file path, giving the ``OMITTED`` placeholder,
+    if the file is over the limits, else '' after subtracting its size from what is left of ``maxbytes``.
+    The size is taken before opening the file.
+    """
+    left = [maxbytes]
+    def over(pd):
+        try:
+            size = filesize(pd)
+        except OSError: #let filecontent tell
+            return ''
+        if (maxfilebytes is not None and size > maxfilebytes
+            or left[0] is not None and size > left[0]):
+            if stats:
+                stats.count('omitted_files')
+            return OMITTED.format(size,'bytes')
+        if left[0] is not None:
+            left[0] -= size
+        return ''
+    return over
 def tree_to_view(rootpath = None
          ,with_dot=False
          ,with_files=True
          ,with_content=True
          ,with_binary=False
          ,maxdepth=MAXDEPTH
+         ,stats=None
+         ,jobs=0
+         ,sharddepth=1
+         ,digest=None
+         ,digestcache=None
+         ,since=None
+         ,maxfilebytes=None
+         ,maxbytes=None
+         ,maxentries=None
+         ,prefix=None
+         ,ignoreroot=None
          #uses
          ,isdir = isdir
          ,normjoin=normjoin
@@ -225,8 +1040,12 @@ def tree_to_view(rootpath = None
          ,listdir=listdir
          ,filecontent=filecontent
          ,readlink=readlink
+         ,filedigest=filedigest
+         ,filetimes=filetimes
+         ,filesize=getsize
          ,name=lambda x:x
          ,up=dirname
+         ,gitignore=None
          ):
     """
     Returns a generator for an indented text view of a directory,
@@ -238,6 +1057,21 @@ def tree_to_view(rootpath = None
     :param with_content: use this only if all the files are text
     :param with_binary: include binary files
     :param maxdepth: max directory depth to list
+    :param stats: a ``Stats`` instance to update
+    :param jobs: number of processes rendering the subdirectories at sharddepth
+    :param sharddepth: directory depth at which to split the work among the jobs
+    :param digest: ``sha256`` or ``blake2b`` (any ``hashlib`` name):
+        a manifest with ``name size algo:hex`` per file, instead of the content
+    :param digestcache: dict of digests to reuse for unchanged files, see ``DigestCache``
+    :param since: only entries modified or changed (moved, chmod) from this time (seconds since the epoch) on,
+        with their directories; directories changed without their entries changing (moved) are listed in full.
+        Removed entries are not listed: use ``tree_delta`` against a saved listing for them
+    :param maxfilebytes: files larger than this are listed as ``name [size bytes omitted]``, without content
+    :param maxbytes: the same for files whose content would exceed this total
+    :param maxentries: a directory lists this many entries, then ``./ [n entries omitted]``
+    :param prefix: internal use
+    :param ignoreroot: internal use
+    :param gitignore: tells whether to skip a path, else from the ``.gitignore`` above rootpath
 
     :return: generator for the lines
 
@@ -246,30 +1080,93 @@ def tree_to_view(rootpath = None
         rootpath = cwd()
     rootdir = rootpath
     lenprefix = len(MID_END[0])
-    gitignore = GitIgnore(start=rootpath,listdir=listdir,up=up,normjoin=normjoin,filecontent=filecontent,name=name)
-    def _tree(p, prefix):
+    fsuses = (isdir,normjoin,islink,listdir,filecontent,readlink,up) == _fsuses and gitignore is None
+    if stats:
+        listdir = stats.wrap(listdir,'listdir')
+        filecontent = stats.wrap(filecontent,'filecontent',lambda a,r:_size(r or b''))
+    if gitignore is None:
+        gitignore = GitIgnore(start=rootpath if ignoreroot is None else ignoreroot
+                          ,listdir=listdir,up=up,normjoin=normjoin,filecontent=filecontent,name=name)
+    if stats:
+        gitignore = stats.wrap(gitignore,'gitignore')
+        filetimes = stats.wrap(filetimes,'filetimes')
+    budget = _budget(maxfilebytes,maxbytes,filesize,stats) if with_content and (
+        maxfilebytes is not None or maxbytes is not None) and not digest else None
+    def changed(pd,since):
+        try:
+            mt,ct = filetimes(pd)
+        except OSError: #gone: let the entry decide
+            return True,True
+        return mt >= since,ct >= since
+    if digest:
+        import hashlib
+        hashlib.new(digest) #ValueError if unknown
+        if digestcache is not None:
+            filedigest = partial(filedigest,cache=digestcache)
+    def listable(pd, d):
+        if gitignore(pd):
+            if stats:
+                stats.count('ignored')
+            return False
+        if not with_dot and name(d).startswith('.'):
+            return False
+        return with_files or islink(pd) or isdir(pd)
+    def _tree(p, prefix, shard=None, since=since):
         ds = listdir(p)
         lends = len(ds)
         if len(prefix)//lenprefix >= maxdepth:
             return
-        for i, d in enumerate(sorted(ds)):
+        listed = 0
+        ds = sorted(ds)
+        for i, d in enumerate(ds):
             pd = normjoin(p, d)
-            if gitignore(pd):
+            if not listable(pd, d):
                 continue
+            if listed == maxentries:
+                n = 1 + sum(1 for x in ds[i+1:] if listable(normjoin(p, x), x))
+                if stats:
+                    stats.count('omitted_entries',n)
+                yield prefix + MID_END[1] + './' + OMITTED.format(n,'entries')
+                break
+            listed += 1
             dn = name(d)
-            if not with_dot and dn.startswith('.'):
-                continue
             padding = prefix + MID_END[i==lends-1]
+            if since is not None:
+                mt,ct = changed(pd,since)
             if islink(pd):
+                if since is not None and not (mt or ct):
+                    continue
                 try:
                     rlink = readlink(pd)
                 except Exception: # pragma: no cover
                     rlink = ''
                 yield padding + dn + ' ' + LNKR + ' ' + rlink
             elif isdir(pd):
+                subprefix = prefix + SUB_MID_END[i==lends-1]
+                if since is not None:
+                    #moved in: ctime, but not mtime, is new, and so are not those of the entries
+                    sub = list(_tree(pd, subprefix, None, None if ct and not mt else since))
+                    if sub or mt or ct:
+                        yield padding + dn + '/'
+                        yield from sub
+                    continue
                 yield padding + dn + '/'
-                yield from _tree(pd, prefix + SUB_MID_END[i==lends-1])
+                if shard and len(subprefix)//lenprefix == sharddepth:
+                    yield shard(pd, subprefix)
+                else:
+                    yield from _tree(pd, subprefix, shard)
             elif with_files:
+                if since is not None and not (mt or ct):
+                    if stats:
+                        stats.count('unchanged')
+                    continue
+                if digest:
+                    yield padding + dn, pd
+                    continue
+                omitted = budget and budget(pd)
+                if omitted:
+                    yield padding + dn + omitted
+                    continue
                 yield padding + dn
                 if with_content:
                     tpad = ' '*len(prefix + 2*SUB_MID_END[1])
@@ -277,7 +1174,25 @@ def tree_to_view(rootpath = None
                                          ,with_binary=with_binary
                                          ,filecontent=filecontent
                                          )
-    return _tree(rootdir, '')
+    prefix = prefix or ''
+    if digest:
+        def tree(*a):
+            return _digested(_tree(*a),digest,filedigest,stats)
+    else:
+        tree = _tree
+    if jobs > 1 and fsuses and digestcache is None and since is None and maxbytes is None:
+        return _sharded(tree_to_view,tree,rootdir,prefix,jobs,stats
+                        ,dict(with_dot=with_dot
+                             ,with_files=with_files
+                             ,with_content=with_content
+                             ,with_binary=with_binary
+                             ,maxdepth=maxdepth
+                             ,digest=digest
+                             ,maxfilebytes=maxfilebytes
+                             ,maxentries=maxentries
+                             ,ignoreroot=rootpath if ignoreroot is None else ignoreroot
+                             ))
+    return tree(rootdir, prefix)
 
 def rindices(regex, lns):
     regex = re.compile(regex)
@@ -286,27 +1201,58 @@ def rindices(regex, lns):
             yield i
 def intervals(nms):
     return list(zip(nms[:], nms[1:]))
+class _Grammar:
+    """
+    The regular expressions for the current tree characters,
+    and the classification of the lines of a view, done once per line.
+    """
+    def __init__(self):
+        dwn = re.escape(DWN)
+        lnkr = re.escape(LNKR)
+        self._re_pth_plus = re.compile(r'^([\w\.][^ </\\]*)(\s*'+dwn+r'\s*|\s*[\\/]\s*|\s*'+lnkr+r'\s*)*([\w\.].*)*')
+        self._re_lnk_pth_plus = re.compile(r'^(/?[\w\.][^ </\\]*)(\s*'+dwn+r'\s*|\s*[\\/]\s*|\s*'+lnkr+r'\s*)*([\w\.].*)*') #for symlink
+        self._re_entry = re.compile(r'/?[\w\.]') #start of _re_lnk_pth_plus
+        self._re_skip = re.compile(r'[^\s'+re.escape(MID+VER+END+HOR)+']')
+        self._re_skip_middle = re.compile(r'[^\s'+re.escape(VER)+']')
+        self._re_to_file = re.compile(r'['+re.escape(MID+END)+']')
+        self._re_space = re.compile(r'[^ ]')
+        self._re_omitted = re.compile(re.escape(OMITTED).replace(r'\{\}',r'\d+',1).replace(r'\{\}',r'\w+',1)+'$')
+        self.to_file = set(MID+END)
+    def classify(self,lines):
+        """
+        Per line the column of the first name character (-1 if none)
+        and the last column of a MID or END character (-1 if none).
+        """
+        skips,tofiles = [],[]
+        search = self._re_skip.search
+        for t in lines:
+            m = search(t)
+            skips.append(m.start() if m else -1)
+            tofiles.append(max(t.rfind(c) for c in self.to_file))
+        return skips,tofiles
+_grammars = {}
 def _rex():
-    dwn = re.escape(DWN)
-    lnkr = re.escape(LNKR)
-    return argparse.Namespace(
-    _re_pth_plus = re.compile(r'^([\w\.][^ </\\]*)(\s*'+dwn+r'\s*|\s*[\\/]\s*|\s*'+lnkr+r'\s*)*([\w\.].*)*')
-    ,_re_lnk_pth_plus = re.compile(r'^(/?[\w\.][^ </\\]*)(\s*'+dwn+r'\s*|\s*[\\/]\s*|\s*'+lnkr+r'\s*)*([\w\.].*)*') #for symlink
-    ,_re_skip = re.compile(r'[^\s'+re.escape(MID+VER+END+HOR)+']')
-    ,_re_skip_middle = re.compile(r'[^\s'+re.escape(VER)+']')
-    ,_re_to_file = re.compile(r'['+re.escape(MID+END)+']')
-    ,_re_space = re.compile(r'[^ ]')
-    )
+    """The grammar for the current tree characters, compiled once"""
+    key = (MID,END,HOR,VER,LNKR,DWN)
+    g = _grammars.get(key)
+    if g is None:
+        g = _grammars[key] = _Grammar()
+    return g
 def view_to_tree(view_str_list
          ,fullpthroot=None
+         ,removals=False
          #uses
          ,cwd=cwd
          ,mkdir=mkdir
          ,symlink=symlink
          ,withcwd=with_cwd
          ,filewrite=filewrite
+         ,exists=exists
+         ,remove=remove
+         ,urlretrieve=urlretrieve
          ,eprint=eprint
          ,r=None
+         ,stats=None
          ):
     """
     Build a directory from a indented text view as returned by view_to_tree().
@@ -319,85 +1265,112 @@ def view_to_tree(view_str_list
 
     - ``<<`` to copy file from internet using ``http://`` or locally using ``file:///``
 
+    - Ending in `` ><``: remove the entry, with ``removals`` (see ``tree_delta``)
+
     - Not starting with ├└ are file content.
       The first line must not be empty.
 
     :param view_str_list: list of lines
     :param fullpthroot: internal use
+    :param removals: remove the entries ending in `` ><``, only below the current directory
+    :param stats: a ``Stats`` instance to update
 
     """
 
     _r = r or _rex()
-    pwd = cwd()
     if not fullpthroot:
-        fullpthroot = pwd
-    for treestart, t in enumerate(view_str_list):
-        try:
-            ct = _r._re_skip.search(t).span()[0]
-            break
-        except Exception:
-            continue
-    sublst = [t[ct:].rstrip() for t in view_str_list[treestart:]]
-    isublst = list(rindices(_r._re_lnk_pth_plus, sublst))
-    isublst.append(len(sublst))
-    for strt, last in intervals(isublst):
-        file_entry = sublst[strt]
-        try:
-            efile, delim, url = _r._re_pth_plus.match(file_entry).groups()
-        except Exception: #/symlink/rel/to/root <- name
-            lnk = fullpthroot+file_entry
-            lndst = basename(lnk)
-            try:
-                _,lndst = lndst.split(LNKL)
-                lnk,_ = lnk.split(LNKL)
-            except Exception:
-                pass
+        fullpthroot = cwd()
+    if remove is _fsremove:
+        remove = partial(remove,root=fullpthroot)
+    if stats:
+        mkdir,symlink,filewrite = _wrap_apply(stats,mkdir,symlink,filewrite)
+        remove = stats.wrap(remove,'remove')
+    lines = [t.rstrip() for t in view_str_list]
+    skips,tofiles = _r.classify(lines)
+    if stats:
+        stats.count('regex',len(lines))
+    def skip(i,base):
+        # column of the first name character at or after base
+        c = skips[i]
+        if c >= base or c < 0:
+            return c
+        m = _r._re_skip.search(lines[i],base) # line less indented than its level
+        return m.start() if m else -1
+    def isentry(i,ct):
+        c = skips[i]
+        if c > ct or c < 0:
+            return False
+        if stats:
+            stats.count('regex')
+        return _r._re_entry.match(lines[i],ct) is not None
+    def _level(lo,hi,base):
+        pwd = cwd()
+        for treestart in range(lo,hi):
+            ct = skip(treestart,base)
+            if ct >= 0:
+                break
+        else:
+            return
+        isublst = [i for i in range(treestart,hi) if isentry(i,ct)]
+        isublst.append(hi)
+        for strt, last in intervals(isublst):
+            file_entry = lines[strt][ct:]
+            if file_entry.endswith(' '+RMV):
+                _removal(file_entry,removals,remove,eprint)
+                continue
+            if stats:
+                stats.count('regex')
             try:
-                lnk = relpath(lnk.strip().strip('/'),pwd.strip('/'))
-                symlink(lnk,lndst.strip())
-            except Exception:
-                pass
-            continue
-        if efile:
-            if strt < last - 1:
-                nxtline = sublst[strt + 1]
+                efile, delim, url = _r._re_pth_plus.match(file_entry).groups()
+            except Exception: #/symlink/rel/to/root <- name
+                lnk = fullpthroot+file_entry
+                lndst = basename(lnk)
                 try:
-                    _ = _r._re_to_file.search(nxtline).span()[0]
-                    # file name starter found
-                    mkdir(efile)
-                    with withcwd(efile):
-                        view_str_list = sublst[strt + 1:last]
-                        view_to_tree(view_str_list,fullpthroot
-                                     ,cwd=cwd
-                                     ,mkdir=mkdir
-                                     ,symlink=symlink
-                                     ,withcwd=withcwd
-                                     ,filewrite=filewrite
-                                     ,eprint=eprint
-                                     )
-                except Exception:# .. else file content
-                    cntent = sublst[strt + 1:last]
-                    ct = 0
-                    try:
-                        ct = _r._re_skip_middle.search(cntent[0]).span()[0]
-                    except Exception:
-                        eprint(strt, last, '\n'.join(cntent[:10]))
-                        eprint("FIRST LINE OF FILE CONTENT MUST NOT BE EMPTY!")
-                    cntlns = [t[ct:] + '\n' for t in cntent]
-                    fileput(efile,cntlns,filewrite=filewrite)
-            elif delim:
-                if '\\' in delim or '/' in delim:
-                    mkdir(efile)
-                elif LNKR in delim and url and efile: #name -> ../rel/to/here
-                    try:
-                        symlink(url,efile)
-                    except Exception:
-                        pass
-                elif DWN in delim:
-                    urlretrieve(url, efile,filewrite=filewrite,eprint=eprint)
-            else:
-                if not exists(efile):
-                    filewrite(efile,'')
+                    _,lndst = lndst.split(LNKL)
+                    lnk,_ = lnk.split(LNKL)
+                except Exception:
+                    pass
+                try:
+                    lnk = relpath(lnk.strip().strip('/'),pwd.strip('/'))
+                    symlink(lnk,lndst.strip())
+                except Exception:
+                    pass
+                continue
+            if efile:
+                if strt < last - 1:
+                    subtree = tofiles[strt + 1] >= ct
+                    if subtree: # file name starter found
+                        try:
+                            mkdir(efile)
+                            with withcwd(efile):
+                                _level(strt + 1,last,ct)
+                        except Exception:
+                            subtree = False
+                    if not subtree: # .. else file content
+                        cntent = lines[strt + 1:last]
+                        cc = ct
+                        m = _r._re_skip_middle.search(cntent[0],ct)
+                        if m:
+                            cc = m.start()
+                        else:
+                            eprint(strt, last, '\n'.join(t[ct:] for t in cntent[:10]))
+                            eprint("FIRST LINE OF FILE CONTENT MUST NOT BE EMPTY!")
+                        cntlns = [t[cc:] + '\n' for t in cntent]
+                        fileput(efile,cntlns,filewrite=filewrite)
+                elif delim:
+                    if '\\' in delim or '/' in delim:
+                        mkdir(efile)
+                    elif LNKR in delim and url and efile: #name -> ../rel/to/here
+                        try:
+                            symlink(url,efile)
+                        except Exception:
+                            pass
+                    elif DWN in delim:
+                        urlretrieve(url, efile,filewrite=filewrite,eprint=eprint)
+                else:
+                    if not exists(efile):
+                        filewrite(efile,'')
+    _level(0,len(lines),0)
 
 def tree_to_flat(rootpath = None
          ,with_dot=False
@@ -405,6 +1378,17 @@ def tree_to_flat(rootpath = None
          ,with_content=True
          ,with_binary=False
          ,maxdepth=MAXDEPTH
+         ,stats=None
+         ,jobs=0
+         ,sharddepth=1
+         ,digest=None
+         ,digestcache=None
+         ,since=None
+         ,maxfilebytes=None
+         ,maxbytes=None
+         ,maxentries=None
+         ,prefix=None
+         ,ignoreroot=None
          #uses
          ,isdir = isdir
          ,normjoin=normjoin
@@ -412,8 +1396,12 @@ def tree_to_flat(rootpath = None
          ,listdir=listdir
          ,filecontent=filecontent
          ,readlink=readlink
+         ,filedigest=filedigest
+         ,filetimes=filetimes
+         ,filesize=getsize
          ,name=lambda x:x
          ,up=dirname
+         ,gitignore=None
          ):
     """
     Returns a generator for a flat text listing of a directory
@@ -425,6 +1413,21 @@ def tree_to_flat(rootpath = None
     :param with_content: use this only if all the files are text
     :param with_binary: include binary files
     :param maxdepth: max directory depth to list
+    :param stats: a ``Stats`` instance to update
+    :param jobs: number of processes rendering the subdirectories at sharddepth
+    :param sharddepth: directory depth at which to split the work among the jobs
+    :param digest: ``sha256`` or ``blake2b`` (any ``hashlib`` name):
+        a manifest with ``name size algo:hex`` per file, instead of the content
+    :param digestcache: dict of digests to reuse for unchanged files, see ``DigestCache``
+    :param since: only entries modified or changed (moved, chmod) from this time (seconds since the epoch) on,
+        with their directories; directories changed without their entries changing (moved) are listed in full.
+        Removed entries are not listed: use ``tree_delta`` against a saved listing for them
+    :param maxfilebytes: files larger than this are listed as ``name [size bytes omitted]``, without content
+    :param maxbytes: the same for files whose content would exceed this total
+    :param maxentries: a directory lists this many entries, then ``./ [n entries omitted]``
+    :param prefix: internal use
+    :param ignoreroot: internal use
+    :param gitignore: tells whether to skip a path, else from the ``.gitignore`` above rootpath
 
     :return: generator for the lines
 
@@ -433,48 +1436,134 @@ def tree_to_flat(rootpath = None
     if rootpath is None:
         rootpath = cwd()
     rootdir = rootpath
-    gitignore = GitIgnore(start=rootpath,listdir=listdir,up=up,normjoin=normjoin,filecontent=filecontent,name=name)
-    def _tree(p, prefix):
+    fsuses = (isdir,normjoin,islink,listdir,filecontent,readlink,up) == _fsuses and gitignore is None
+    if stats:
+        listdir = stats.wrap(listdir,'listdir')
+        filecontent = stats.wrap(filecontent,'filecontent',lambda a,r:_size(r or b''))
+    if gitignore is None:
+        gitignore = GitIgnore(start=rootpath if ignoreroot is None else ignoreroot
+                          ,listdir=listdir,up=up,normjoin=normjoin,filecontent=filecontent,name=name)
+    if stats:
+        gitignore = stats.wrap(gitignore,'gitignore')
+        filetimes = stats.wrap(filetimes,'filetimes')
+    budget = _budget(maxfilebytes,maxbytes,filesize,stats) if with_content and (
+        maxfilebytes is not None or maxbytes is not None) and not digest else None
+    def changed(pd,since):
+        try:
+            mt,ct = filetimes(pd)
+        except OSError: #gone: let the entry decide
+            return True,True
+        return mt >= since,ct >= since
+    if digest:
+        import hashlib
+        hashlib.new(digest) #ValueError if unknown
+        if digestcache is not None:
+            filedigest = partial(filedigest,cache=digestcache)
+    def listable(pd, d):
+        if gitignore(pd):
+            if stats:
+                stats.count('ignored')
+            return False
+        if not with_dot and name(d).startswith('.'):
+            return False
+        return with_files or islink(pd) or isdir(pd)
+    def _tree(p, prefix, shard=None, since=since):
         ds = listdir(p)
         if len(prefix) >= maxdepth:
             return
-        for i, d in enumerate(sorted(ds)):
+        listed = 0
+        ds = sorted(ds)
+        for i, d in enumerate(ds):
             pd = normjoin(p, d)
-            if gitignore(pd):
+            if not listable(pd, d):
                 continue
+            if listed == maxentries:
+                n = 1 + sum(1 for x in ds[i+1:] if listable(normjoin(p, x), x))
+                if stats:
+                    stats.count('omitted_entries',n)
+                yield ('/'.join(prefix) or '.') + '/' + OMITTED.format(n,'entries')
+                break
+            listed += 1
             dn = name(d)
-            if not with_dot and dn.startswith('.'):
-                continue
             nprefix = prefix+[dn]
             thispth = '/'.join(nprefix)
+            if since is not None:
+                mt,ct = changed(pd,since)
             if islink(pd):
+                if since is not None and not (mt or ct):
+                    continue
                 try:
                     rlink = readlink(pd)
                 except Exception: # pragma: no cover
                     rlink = ''
                 yield thispth + ' ' + LNKR + ' ' + rlink
             elif isdir(pd):
-                entries = list(_tree(pd, nprefix))
+                if shard and len(nprefix) == sharddepth:
+                    yield shard(pd, nprefix)
+                    continue
+                if since is not None:
+                    #moved in: ctime, but not mtime, is new, and so are not those of the entries
+                    entries = list(_tree(pd, nprefix, None, None if ct and not mt else since))
+                    if entries:
+                        yield from entries
+                    elif mt or ct:
+                        yield thispth + '/'
+                    continue
+                entries = list(_tree(pd, nprefix, shard))
                 if entries:
                     yield from entries
                 else:
                     yield thispth + '/'
             elif with_files:
+                if since is not None and not (mt or ct):
+                    if stats:
+                        stats.count('unchanged')
+                    continue
+                if digest:
+                    yield thispth, pd
+                    continue
+                omitted = budget and budget(pd)
+                if omitted:
+                    yield thispth + omitted
+                    continue
                 yield thispth
                 if with_content:
                     yield from fileyield(pd,SUB_MID_END[1]
                                          ,with_binary=with_binary
                                          ,filecontent=filecontent
                                          )
-    return _tree(rootdir,[])
+    prefix = prefix or []
+    if digest:
+        def tree(*a):
+            return _digested(_tree(*a),digest,filedigest,stats)
+    else:
+        tree = _tree
+    if jobs > 1 and fsuses and digestcache is None and since is None and maxbytes is None:
+        return _sharded(tree_to_flat,tree,rootdir,prefix,jobs,stats
+                        ,dict(with_dot=with_dot
+                             ,with_files=with_files
+                             ,with_content=with_content
+                             ,with_binary=with_binary
+                             ,maxdepth=maxdepth
+                             ,digest=digest
+                             ,maxfilebytes=maxfilebytes
+                             ,maxentries=maxentries
+                             ,ignoreroot=rootpath if ignoreroot is None else ignoreroot
+                             ))
+    return tree(rootdir,prefix)
 
 def flat_to_tree(flat_str_list
+         ,removals=False
          #uses
          ,mkdir=mkdir
          ,symlink=symlink
          ,filewrite=filewrite
+         ,exists=exists
+         ,remove=remove
+         ,urlretrieve=urlretrieve
          ,eprint=eprint
          ,r=None
+         ,stats=None
          ):
     """
     Build a directory from a list of strings as returned by tree_to_flat().
@@ -486,21 +1575,39 @@ def flat_to_tree(flat_str_list
 
     - ``<<`` to copy file from internet using ``http://`` or locally using ``file:///``
 
+    - Ending in `` ><``: remove the entry, with ``removals`` (see ``tree_delta``)
+
     - Indented lines are file content.
-      The first line must not be empty.
+      Their indentation is that of the first non-empty line.
 
-    :param flat_str_list: list of lines
+    :param flat_str_list: list or iterator of lines, read only once
+    :param removals: remove the entries ending in `` ><``, only below the current directory
+    :param stats: a ``Stats`` instance to update
 
     """
 
     _r = r or _rex()
-    i,e = 0,None
-    leni = len(flat_str_list)
-    while i<leni:
-        e = flat_str_list[i].rstrip()
-        i = i+1
+    if remove is _fsremove:
+        remove = partial(remove,root=cwd())
+    if stats:
+        mkdir,symlink,filewrite = _wrap_apply(stats,mkdir,symlink,filewrite)
+        remove = stats.wrap(remove,'remove')
+    lines = iter(flat_str_list)
+    pending = [] #lines to read again, last first
+    def nextline():
+        return pending.pop() if pending else next(lines,None)
+    while True:
+        x = nextline()
+        if x is None:
+            break
+        e = x.rstrip()
         if not e:
             continue
+        if e.endswith(' '+RMV):
+            _removal(e,removals,remove,eprint)
+            continue
+        if e.endswith(' omitted]'):
+            e = _r._re_omitted.sub('',e)
         esplit = e.split(LNKR)
         usplit = e.split(DWN)
         if len(esplit) == 2: #islink
@@ -516,7 +1623,7 @@ def flat_to_tree(flat_str_list
             except Exception:
                 pass
         elif len(usplit) == 2:
-            urlretrieve(usplit[1], usplit[0], filewrite=filewrite,eprint=eprint)
+            urlretrieve(usplit[1].strip(), usplit[0].strip(), filewrite=filewrite,eprint=eprint)
         elif e.endswith('/'):
             mkdir(e)
         else:
@@ -524,35 +1631,784 @@ def flat_to_tree(flat_str_list
             if de:
                 mkdir(de)
             indent,fllns = 0,[]
-            try:
-                j = i
-                while j<leni:
-                    x = flat_str_list[j]
-                    if not x or x.startswith(' '):
-                        fllns.append(x)
-                    else: # pragma: no cover (it is covered, but coverage says not)
-                        break
-                    j = j+1
-                ln0 = fllns[0]
-                indent = _r._re_space.search(ln0).span()[0]
-                i = j
-            except Exception:
-                pass
+            x = nextline()
+            while x is not None and (not x or x.startswith(' ')):
+                fllns.append(x)
+                x = nextline()
+            if x is not None:
+                pending.append(x)
+            m = None
+            if fllns:
+                if stats:
+                    stats.count('regex')
+                m = next(filter(None,map(_r._re_space.search,fllns)),None)
+            if m:
+                indent = m.start()
+            else: #only empty lines: read them again as entries
+                pending.extend(reversed(fllns))
             flcntlns = [x[indent:]+'\n' for x in fllns]
             if flcntlns or not exists(e):
                 fileput(e,flcntlns,filewrite=filewrite)
 
-def to_tree(view_or_flat):
+def _wrap_apply(stats,mkdir,symlink,filewrite):
+    return (stats.wrap(mkdir,'mkdir')
+           ,stats.wrap(symlink,'symlink')
+           ,stats.wrap(filewrite,'filewrite',lambda a,r:_size(a[1])))
+def _view_parts(view_str_list,r,reldir='',mkdir=mkdir,maxlines=None):
+    """
+    Split a view at its top level entries.
+    A single top level directory is created and split further,
+    as are directories of more than ``maxlines`` lines.
+    """
+    for treestart, t in enumerate(view_str_list):
+        m = r._re_skip.search(t)
+        if m:
+            ct = m.span()[0]
+            break
+    else:
+        return []
+    sublst = [t[ct:].rstrip() for t in view_str_list[treestart:]]
+    isublst = list(rindices(r._re_lnk_pth_plus, sublst))
+    isublst.append(len(sublst))
+    parts = [(reldir,sublst[strt:last]) for strt,last in intervals(isublst)]
+    res = []
+    for _,part in parts:
+        m = None
+        if len(parts) == 1 or maxlines and len(part) > maxlines:
+            m = r._re_pth_plus.match(part[0])
+        if m and m.group(1) and len(part) > 1 and r._re_to_file.search(part[1]):
+            subdir = normjoin(reldir,m.group(1))
+            mkdir(subdir)
+            res.extend(_view_parts(part[1:],r,subdir,mkdir,maxlines))
+        else:
+            res.append((reldir,part))
+    return res
+def _flat_parts(flat_str_list,depth=1):
+    """
+    Split a flat listing by the first depth path components of the entries.
+    If all entries share them, split by one more component.
+    """
+    groups,key = {},None
+    deeper = False
+    for x in flat_str_list:
+        if x and not x.startswith(' '):
+            pth = x.split(' '+LNKR)[0].split(' '+DWN)[0].strip()
+            cmps = pth.split('/')
+            key = tuple(cmps[:depth])
+            deeper = deeper or len([c for c in cmps if c]) > depth
+        groups.setdefault(key,[]).append(x)
+    if len(groups) == 1 and deeper and depth < MAXDEPTH:
+        return _flat_parts(flat_str_list,depth+1)
+    return [('',lns) for lns in groups.values()]
+def _split_flat(parts,maxlines):
+    """Split the flat parts of more than ``maxlines`` lines at entries"""
+    for reldir,lns in parts:
+        start = 0
+        for i,x in enumerate(lns):
+            if i-start >= maxlines and x and not x.startswith(' '):
+                yield reldir,lns[start:i]
+                start = i
+        yield reldir,lns[start:]
+def _batches(parts,n):
+    """Join consecutive parts of the same directory to about n batches"""
+    size = sum(len(lns) for _,lns in parts)/n
+    batches = []
+    for reldir,lns in parts:
+        if batches and batches[-1][0] == reldir and len(batches[-1][1]) < size:
+            batches[-1][1].extend(lns)
+        else:
+            batches.append((reldir,list(lns)))
+    return batches
+def _apply_in(fun,root,reldir,lines,**kwargs):
+    with with_cwd(normjoin(root,reldir)):
+        fun(lines,**kwargs)
+def _apply_part(fun,chars,root,reldir,lines,with_stats,kwargs):
+    set_tree_chars(**chars)
+    errs = []
+    st = Stats() if with_stats else None
+    _apply_in(fun,root,reldir,lines
+        ,eprint=lambda *a,**ka: errs.append(' '.join(str(x) for x in a))
+        ,stats=st
+        ,**kwargs)
+    return errs, st and st.report()
+def _apply_parallel(fun,parts,jobs,stats=None,eprint=eprint,**kwargs):
+    """
+    Apply the parts of a view or flat listing in a process pool.
+    The parts must create disjoint subtrees below the current directory.
+    Errors and counters of the workers are passed on in order.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    root = cwd()
+    chars = _tree_chars()
+    with ProcessPoolExecutor(jobs) as ex:
+        futures = [ex.submit(_apply_part,fun,chars,root,reldir,lines,bool(stats),kwargs)
+                   for reldir,lines in _batches(parts,4*jobs)]
+        for f in futures:
+            errs,report = f.result()
+            for e in errs:
+                eprint(e)
+            if stats and report:
+                stats.merge(report)
+def detect_format(view_or_flat,r=None):
+    """
+    Tell from the first two non-empty lines, whether a view or a flat listing.
+
+    A view has tree characters in its first entry,
+    or it starts with an indented line or a line followed by a tree line.
+    Flat listing entries start at column 0.
+
+    :param view_or_flat: list or iterator of lines
+    :return: ('view' or 'flat', iterator over all lines)
+
+    >>> detect_format(['a/b.txt','   '+MID_END[0]+'text'])[0]
+    'view'
+    >>> detect_format(['a/b.txt','   text '+MID_END[0]])[0]
+    'flat'
+
+    """
+    _r = r or _rex()
+    lines = iter(view_or_flat)
+    head,fmt,nonempty = [],'flat',0
+    for t in lines:
+        head.append(t)
+        if not t.strip():
+            continue
+        nonempty += 1
+        if nonempty == 1:
+            if _r._re_to_file.search(t) or t[0].isspace():
+                fmt = 'view'
+                break
+        else:
+            if _r._re_to_file.match(t.lstrip()):
+                fmt = 'view'
+            break
+    return fmt, chain(head,lines)
+def to_tree(view_or_flat,stats=None,jobs=0,fmt=None,removals=False,**uses):
     """Check whether a flat listing or indented view,
-    then create the directory accordingly"""
+    then create the directory accordingly.
+    With ``jobs`` > 1, disjoint subtrees are created in a process pool.
+
+    :param view_or_flat: list or iterator of lines
+    :param fmt: 'view' or 'flat', else ``detect_format`` is used
+    :param removals: remove the entries ending in `` ><``, as in a ``tree_delta``
+    :param uses: the ``uses`` of ``view_to_tree``, e.g. from ``ArchiveSink.uses()``;
+        then ``jobs`` is not used
+    """
     _r = _rex()
-    treeidx = list(rindices(_r._re_to_file, view_or_flat))
-    if treeidx:
-        view_to_tree(view_or_flat,r=_r)
+    if fmt is None:
+        fmt,view_or_flat = detect_format(view_or_flat,_r)
+    if uses:
+        jobs = 0
+    if fmt == 'view' or jobs > 1:
+        view_or_flat = list(view_or_flat)
+    if fmt == 'view':
+        if jobs > 1:
+            _apply_parallel(view_to_tree,_view_parts(view_or_flat,_r),jobs,stats
+                            ,fullpthroot=cwd(),removals=removals)
+        else:
+            view_to_tree(view_or_flat,r=_r,stats=stats,removals=removals,**uses)
     else:
-        flat_to_tree(view_or_flat,r=_r)
+        uses.pop('cwd',None) #no current directory needed for flat listings
+        uses.pop('withcwd',None)
+        if jobs > 1:
+            _apply_parallel(flat_to_tree,_flat_parts(view_or_flat),jobs,stats,removals=removals)
+        else:
+            flat_to_tree(view_or_flat,r=_r,stats=stats,removals=removals,**uses)
+
+FICLONE = 0x40049409 #linux ioctl to share the extents of a file (reflink)
+def filecopy(src,dst):
+    """Copy a file's bytes, via reflink or copy_file_range where available"""
+    with open(src,'rb') as fs, open(dst,'wb') as fd:
+        try:
+            import fcntl
+            fcntl.ioctl(fd.fileno(),FICLONE,fs.fileno())
+            return
+        except Exception:
+            pass
+        try:
+            while os.copy_file_range(fs.fileno(),fd.fileno(),1<<30):
+                pass
+            return
+        except Exception:
+            fs.seek(0)
+            fd.seek(0)
+            fd.truncate()
+        import shutil
+        shutil.copyfileobj(fs,fd,1<<20)
+def tree_to_tree(rootpath
+         ,outdir
+         ,with_dot=False
+         ,with_files=True
+         ,with_content=True
+         ,maxdepth=MAXDEPTH
+         ,stats=None
+         #uses
+         ,mkdir=mkdir
+         ,symlink=symlink
+         ,filecopy=filecopy
+         ,filewrite=filewrite
+         ):
+    """
+    Copy a directory directly, without text view in between.
+    The entries are selected like by ``tree_to_view``.
+    Files are copied as they are, text or binary.
+    Links are recreated with the same target.
+
+    :param rootpath: directory to copy
+    :param outdir: directory to copy into
+    :param with_dot: also include files starting with .
+    :param with_files: else only directories are copied
+    :param with_content: else files are created empty
+    :param maxdepth: max directory depth to copy
+    :param stats: a ``Stats`` instance to update
+
+    """
+    if stats:
+        mkdir = stats.wrap(mkdir,'mkdir')
+        symlink = stats.wrap(symlink,'symlink')
+        filecopy = stats.wrap(filecopy,'filecopy',lambda a,r:os.path.getsize(a[1]))
+    gitignore = GitIgnore(start=rootpath)
+    skip = os.path.abspath(outdir) #if outdir is within rootpath
+    def _tree(p, q, depth):
+        if depth >= maxdepth:
+            return
+        with os.scandir(p) as it:
+            ds = list(it)
+        for d in ds:
+            pd = normjoin(p, d.name)
+            if gitignore(pd):
+                if stats:
+                    stats.count('ignored')
+                continue
+            if not with_dot and d.name.startswith('.'):
+                continue
+            qd = normjoin(q, d.name)
+            if d.is_symlink():
+                try:
+                    symlink(readlink(pd),qd)
+                except Exception:
+                    pass
+            elif d.is_dir():
+                if os.path.abspath(pd) == skip:
+                    continue
+                mkdir(qd)
+                _tree(pd, qd, depth+1)
+            elif with_files:
+                if with_content:
+                    filecopy(pd,qd)
+                elif not exists(qd):
+                    filewrite(qd,'')
+    mkdir(outdir)
+    _tree(rootpath, outdir, 0)
+
+class _DeltaSide:
+    """
+    A source of ``tree_delta`` as path -> (kind, link target or content),
+    kind being 'd', 'l' or 'f'.
+    Files are compared as the bytes ``TxDir.tree`` or ``to_tree`` would write,
+    or, against a ``text`` side read from a view or flat listing, as the lines shown in a view.
+    """
+    def __init__(self,src,with_dot,maxdepth):
+        self.root,self.parents,self._data = None,set(),{}
+        self.text = False
+        self.entries = {}
+        if isinstance(src,TxDir):
+            tx = src
+        elif isdir(src):
+            self.root = src
+            for ln in tree_to_flat(src,with_dot=with_dot,with_content=False,maxdepth=maxdepth):
+                if ' '+LNKR+' ' in ln:
+                    pth,tgt = ln.split(' '+LNKR+' ',1)
+                    self._add(pth,('l',tgt))
+                elif ln.endswith('/'):
+                    self._add(ln[:-1],('d',None))
+                else:
+                    self._add(ln,('f',None))
+            return
+        elif isarchive(src):
+            tx = TxDir.fromfs(src,with_dot=with_dot,with_binary=True,maxdepth=maxdepth)
+        else:
+            with open(src,encoding='utf-8') as f:
+                tx = _totxdir(f.read().splitlines())
+            self.text = True
+        stack = [('',tx,0)]
+        while stack:
+            pth,e,depth = stack.pop()
+            for c in e.content:
+                if not with_dot and c.name.startswith('.'):
+                    continue
+                p = pth+'/'+c.name if pth else c.name
+                if c.isdir():
+                    self._add(p,('d',None))
+                    if depth+1 < maxdepth:
+                        stack.append((p,c,depth+1))
+                else:
+                    self._add(p,('l',c.content) if c.islink() else ('f',c.content))
+    def _add(self,pth,entry):
+        self.entries[pth] = entry
+        d = dirname(pth)
+        while d and d not in self.parents:
+            self.parents.add(d)
+            self.entries.setdefault(d,('d',None))
+            d = dirname(d)
+    def data(self,pth):
+        b = self._data.get(pth)
+        if b is None:
+            c = self.entries[pth][1]
+            if len(c)==1 and c[0].startswith("b'") and c[0].rstrip().endswith("'"):
+                from base64 import b64decode
+                b = b64decode(c[0].rstrip()[2:-1].encode())
+            else:
+                b = ''.join(c).encode('utf-8')
+            self._data[pth] = b
+        return b
+    def size(self,pth):
+        if self.root is None:
+            return len(self.data(pth))
+        return os.lstat(normjoin(self.root,pth)).st_size
+    def digest(self,pth):
+        import hashlib
+        h = hashlib.blake2b()
+        if self.root is None:
+            h.update(self.data(pth))
+        else:
+            with open(normjoin(self.root,pth),'rb') as f:
+                for b in iter(partial(f.read,1<<20),b''):
+                    h.update(b)
+        return h.digest()
+    def lines(self,pth,tpad):
+        if self.root is not None:
+            yield from fileyield(normjoin(self.root,pth),tpad,with_binary=True)
+            return
+        for ln in self.entries[pth][1]:
+            tmpln = ln.rstrip()
+            yield tpad + tmpln if tmpln else ''
+def _totxdir(lines):
+    fmt,lines = detect_format(lines)
+    return TxDir.fromview(list(lines)) if fmt == 'view' else TxDir.fromflat(lines)
+def tree_delta(old
+         ,new
+         ,with_dot=False
+         ,maxdepth=MAXDEPTH
+         ,stats=None
+         ):
+    """
+    Returns a generator for a flat listing of what changed from ``old`` to ``new``.
+    Applied to ``old`` with ``to_tree`` or ``flat_to_tree``, it makes it equal to ``new``.
+
+    - Added or changed files come with content, added links and empty directories as usual.
+
+    - Removed entries end in `` ><``. A link or file that changed kind, is removed first.
+
+    Files are compared by size, then by hash; only changed files are read fully.
+    Against a view or flat listing file, files are compared by their lines in a view,
+    which has no trailing blanks.
+
+    :param old: directory, tar or zip file, view or flat listing file, or ``TxDir``
+    :param new: same kinds as ``old``
+    :param with_dot: also compare files starting with .
+    :param maxdepth: max directory depth to compare
+    :param stats: a ``Stats`` instance to update
+
+    :return: generator for the lines
+
+    """
+    a = _DeltaSide(old,with_dot,maxdepth)
+    b = _DeltaSide(new,with_dot,maxdepth)
+    tpad = SUB_MID_END[1]
+    bytewise = a.text == b.text #else compare the view lines, as the text side has no others
+    gone = set() #removed directories
+    def removed(pth):
+        d = dirname(pth)
+        while d:
+            if d in gone:
+                return True
+            d = dirname(d)
+        return False
+    for pth in sorted(a.entries.keys()|b.entries.keys()):
+        ea,eb = a.entries.get(pth),b.entries.get(pth)
+        if removed(pth):
+            ea = None
+        if ea and eb and ea[0] == eb[0]:
+            if ea[0] == 'd':
+                continue
+            if ea[0] == 'l':
+                if ea[1] == eb[1]:
+                    continue
+            else:
+                if stats:
+                    stats.count('compared')
+                if not bytewise:
+                    if list(a.lines(pth,'')) == list(b.lines(pth,'')):
+                        continue
+                elif a.size(pth) == b.size(pth):
+                    if stats:
+                        stats.count('hashed')
+                    if a.digest(pth) == b.digest(pth):
+                        continue
+                if b.size(pth):
+                    ea = None #overwritten
+        if ea:
+            if stats:
+                stats.count('removed')
+            if ea[0] == 'd':
+                gone.add(pth)
+                yield pth+'/ '+RMV
+            else:
+                yield pth+' '+RMV
+        if eb:
+            if stats:
+                stats.count('written')
+            if eb[0] == 'd':
+                if pth not in b.parents:
+                    yield pth+'/'
+            elif eb[0] == 'l':
+                yield pth+' '+LNKR+' '+eb[1]
+            else:
+                yield pth
+                yield from b.lines(pth,tpad)
+
+def _dedented(lines):
+    indent = min((len(x)-len(x.lstrip(' ')) for x in lines if x),default=0)
+    return [x[indent:] for x in lines]
+VERIFYPOOLSIZE = 1<<16 #files from this size on are compared in the thread pool
+class _Mismatch(BaseException): #not caught by the appliers' except Exception
+    pass
+class _Verifier:
+    """
+    The uses of the appliers, comparing with the directory at ``root`` instead of writing.
+    Files are compared in a thread pool: by size, then by hash.
+    Text files are compared by their lines in a view, as the view or flat listing has no others.
+    """
+    def __init__(self,root,jobs,full,stats):
+        from concurrent.futures import ThreadPoolExecutor
+        self.root,self.full,self.stats = root.replace('\\','/').rstrip('/') or '/',full,stats
+        self.prefix = self.root.rstrip('/')+'/'
+        self.current = ''
+        self.seen,self.dirs = set(),set()
+        self.mismatches = []
+        from collections import deque
+        self.pool = ThreadPoolExecutor(jobs or None)
+        self.pending = deque()
+    def key(self,apath):
+        if '/' in apath or '\\' in apath or apath in ('.','..'):
+            return normjoin('/',self.current,apath.replace('\\','/')).strip('/')
+        return self.current+'/'+apath if self.current else apath
+    def see(self,pth):
+        pd = self.prefix+pth if pth else self.root
+        while pth and pth not in self.seen:
+            self.seen.add(pth)
+            pth = dirname(pth)
+        return pd
+    def mismatch(self,pth,reason):
+        self.mismatches.append((pth,reason))
+        if not self.full:
+            raise _Mismatch()
+    def reap(self,wait=False):
+        q = self.pending
+        while q and (wait or q[0][1].done()):
+            pth,fut = q.popleft()
+            reason = fut.result()
+            if reason:
+                self.mismatch(pth,reason)
+    @staticmethod
+    def compare(pd,data):
+        import stat
+        try:
+            f = open(pd,'rb')
+        except FileNotFoundError:
+            return 'missing'
+        except OSError:
+            return 'not a file'
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return 'not a file'
+            if isinstance(data,list): #lines without trailing blanks
+                lines = list(fileyield(pd,'',with_binary=True))
+                if data[:1] == ['']: #content indented from the entry in a view, see view_to_tree
+                    lines,data = _dedented(lines),_dedented(data)
+                return None if lines == data else 'content'
+            if st.st_size != len(data):
+                return 'size'
+            if len(data) < VERIFYPOOLSIZE:
+                return None if f.read() == data else 'content'
+            import hashlib
+            h = hashlib.blake2b()
+            for b in iter(partial(f.read,1<<20),b''):
+                h.update(b)
+        if h.digest() != hashlib.blake2b(data).digest():
+            return 'content'
+    def mkdir(self,apath):
+        pth = self.key(apath)
+        if pth in self.dirs:
+            return
+        self.dirs.add(pth)
+        pd = self.see(pth)
+        if not isdir(pd) or islink(pd):
+            self.mismatch(pth,'not a directory' if exists(pd) else 'missing')
+    def symlink(self,lnk,apath):
+        pth = self.key(apath)
+        pd = self.see(pth)
+        if not islink(pd):
+            self.mismatch(pth,'not a link' if exists(pd) else 'missing')
+        elif readlink(pd) != lnk:
+            self.mismatch(pth,'link')
+    def filewrite(self,apath,cntlns):
+        pth = self.key(apath)
+        pd = self.see(pth)
+        if isinstance(cntlns,bytes):
+            data,size = cntlns,len(cntlns)
+        else:
+            data = [ln.rstrip() for ln in cntlns]
+            size = sum(map(len,data))
+        if self.stats:
+            self.stats.count('compared')
+        if size < VERIFYPOOLSIZE: #not worth a thread
+            reason = self.compare(pd,data)
+            if reason:
+                self.mismatch(pth,reason)
+        else:
+            self.pending.append((pth,self.pool.submit(self.compare,pd,data)))
+            self.reap()
+    def exists(self,apath): #entry without content: only check the kind
+        pth = self.key(apath)
+        pd = self.see(pth)
+        if not isfile(pd) or islink(pd):
+            self.mismatch(pth,'not a file' if exists(pd) else 'missing')
+        return True
+    def remove(self,apath):
+        pth = self.key(apath)
+        if os.path.lexists(normjoin(self.root,pth)):
+            self.mismatch(pth,'not removed')
+    def urlretrieve(self,url,tofile,**kwargs): #no download: only check the kind
+        self.exists(tofile)
+    @contextlib.contextmanager
+    def withcwd(self,apath):
+        prev = self.current
+        self.current = self.key(apath)
+        try:
+            yield
+        finally:
+            self.current = prev
+    def uses(self):
+        return dict(mkdir=self.mkdir,symlink=self.symlink,filewrite=self.filewrite
+                    ,exists=self.exists,remove=self.remove,urlretrieve=self.urlretrieve
+                    ,cwd=lambda:'/'+self.current,withcwd=self.withcwd)
+def verify(view_or_flat
+         ,rootpath
+         ,jobs=0
+         ,full=False
+         ,extras=True
+         ,with_dot=False
+         ,fmt=None
+         ,stats=None
+         ):
+    """
+    Compare the directory ``rootpath`` with a view or flat listing,
+    without writing and without rendering the directory.
+    Stop at the first mismatch, unless ``full``.
+    Text files are compared by their lines in a view, which has no trailing blanks,
+    binary files listed ``with_binary`` by their bytes.
+    Entries to download (``<<``) are not downloaded, only checked to be files.
+
+    :param view_or_flat: list or iterator of lines
+    :param rootpath: directory to check
+    :param jobs: number of threads comparing files, 0 for the default
+    :param full: check all entries, else stop at the first mismatch
+    :param extras: also report entries in ``rootpath`` not in the view, as ``tree_to_flat`` lists them
+    :param with_dot: with ``extras``: also files starting with .
+    :param fmt: 'view' or 'flat', else ``detect_format`` is used
+    :param stats: a ``Stats`` instance to update
+
+    :return: sorted list of (path, reason), empty if equal
+
+    """
+    v = _Verifier(rootpath,jobs,full,stats)
+    try:
+        try:
+            to_tree(view_or_flat,fmt=fmt,removals=True,**v.uses()) #only checked
+            v.reap(wait=True)
+        except _Mismatch:
+            pass
+        if extras and (full or not v.mismatches):
+            for ln in tree_to_flat(rootpath,with_dot=with_dot,with_content=False):
+                pth = ln.split(' '+LNKR+' ',1)[0].rstrip('/')
+                if pth not in v.seen:
+                    v.mismatches.append((pth,'extra'))
+                    if not full:
+                        break
+    finally:
+        for _,fut in v.pending:
+            fut.cancel()
+        v.pool.shutdown()
+    if stats:
+        stats.count('mismatches',len(v.mismatches))
+    return sorted(v.mismatches)
+
+def _libc():
+    import ctypes
+    return ctypes.CDLL(None,use_errno=True)
+def fsyncpath(pth):
+    """fsync a file or directory, if the OS allows"""
+    try:
+        fd = os.open(pth,os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError: #e.g. dangling link, or a directory on Windows
+        pass
+def syncfs(pth):
+    """Flush the file system holding ``pth`` in one call,
+    else fsync everything below ``pth``"""
+    fd = os.open(pth,os.O_RDONLY)
+    try:
+        if _libc().syncfs(fd) == 0:
+            return
+    except Exception:
+        pass
+    finally:
+        os.close(fd)
+    for dp,dns,fns in os.walk(pth,topdown=False):
+        for n in fns:
+            fsyncpath(normjoin(dp,n))
+        fsyncpath(dp)
+RENAME_EXCHANGE = 2 #linux renameat2 flag
+AT_FDCWD = -100
+def exchange(a,b):
+    """Swap two paths atomically, if renameat2 is available"""
+    try:
+        return _libc().renameat2(AT_FDCWD,os.fsencode(a)
+                                ,AT_FDCWD,os.fsencode(b),RENAME_EXCHANGE) == 0
+    except Exception:
+        return False
+@contextlib.contextmanager
+def staged(outdir
+         ,stats=None
+         #uses
+         ,filecopy=filecopy
+         ,syncfs=syncfs
+         ,fsyncpath=fsyncpath
+         ,exchange=exchange
+         ):
+    """
+    Apply all or nothing to ``outdir``.
+    Yields a staging directory next to ``outdir``, with a copy of ``outdir`` in it.
+    If the block succeeds, the stage is synced once and swapped with ``outdir``,
+    via ``renameat2(RENAME_EXCHANGE)``, else via two renames.
+    If the block or the swap fails, ``outdir`` is left as it was.
+
+    :param outdir: the directory to update
+    :param stats: a ``Stats`` instance to update
+
+    """
+    import shutil
+    import tempfile
+    phase = stats.phase if stats else lambda x: contextlib.nullcontext()
+    outdir = os.path.abspath(outdir).replace('\\', '/')
+    parent,name = dirname(outdir),basename(outdir)
+    mkdir(parent)
+    stage = tempfile.mkdtemp(prefix='.'+name+'.',suffix='.stage',dir=parent)
+    try:
+        with phase('stage'):
+            if isdir(outdir):
+                def copy(src,dst):
+                    filecopy(src,dst)
+                    shutil.copystat(src,dst)
+                os.rmdir(stage) #copytree makes it anew, with the mode of outdir
+                shutil.copytree(outdir,stage,symlinks=True,copy_function=copy)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(stage,0o777&~umask)
+        yield stage
+        with phase('sync'):
+            syncfs(stage)
+        with phase('swap'):
+            if not isdir(outdir):
+                os.rename(stage,outdir)
+            elif not exchange(stage,outdir):
+                os.rename(outdir,stage+'.old')
+                try:
+                    os.rename(stage,outdir)
+                except OSError:
+                    os.rename(stage+'.old',outdir) #put the old one back
+                    raise
+                os.rename(stage+'.old',stage)
+            fsyncpath(parent)
+    finally:
+        shutil.rmtree(stage,ignore_errors=True)
+
+#async
+async def _abatched(fun,batch,executor,*args,**kwargs):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    lines = await loop.run_in_executor(executor,partial(fun,*args,**kwargs))
+    while True:
+        chunk = await loop.run_in_executor(executor,partial(list,islice(lines,batch)))
+        if not chunk:
+            break
+        for ln in chunk:
+            yield ln
+def atree_to_view(rootpath=None,batch=256,executor=None,**kwargs):
+    """
+    Async generator for the lines of ``tree_to_view``.
+
+    The file system is accessed in the executor, ``batch`` lines at a time,
+    only when the caller asks for more lines.
+
+    :param batch: number of lines produced per executor call
+    :param executor: executor to use, None for the default of the loop
+
+    """
+    return _abatched(tree_to_view,batch,executor,rootpath,**kwargs)
+def atree_to_flat(rootpath=None,batch=256,executor=None,**kwargs):
+    """
+    Async generator for the lines of ``tree_to_flat``.
+    See ``atree_to_view``.
+    """
+    return _abatched(tree_to_flat,batch,executor,rootpath,**kwargs)
+async def ato_tree(view_or_flat,outdir=None,batch=1000,executor=None,stats=None,eprint=eprint,fmt=None,removals=False):
+    """
+    Awaitable ``to_tree`` into ``outdir``.
+
+    The input is split at top level entries, like for ``to_tree(jobs=n)``,
+    and applied in the executor about ``batch`` lines at a time;
+    larger directories are split further.
+    The current directory of the process is not changed.
+    Cancelling stops after the running batch.
+
+    :param view_or_flat: list or iterator of lines
+    :param outdir: directory to create the tree in, default is the current one
+    :param batch: number of lines applied per executor call
+    :param executor: executor to use, None for the default of the loop
+    :param fmt: 'view' or 'flat', else ``detect_format`` is used
+    :param removals: remove the entries ending in `` ><``, as in a ``tree_delta``
+
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    root = os.path.abspath(outdir or cwd()).replace('\\','/')
+    mkdir(root)
+    _r = _rex()
+    def parts():
+        f,lines = (fmt,view_or_flat) if fmt else detect_format(view_or_flat,_r)
+        lines = list(lines)
+        if f == 'view':
+            return view_to_tree,_view_parts(lines,_r,mkdir=_Rooted(root).uses()['mkdir'],maxlines=batch),dict(fullpthroot=root)
+        return flat_to_tree,list(_split_flat(_flat_parts(lines),batch)),{}
+    fun,prts,kwargs = await loop.run_in_executor(executor,parts)
+    nbatches = max(1,sum(len(lns) for _,lns in prts)//batch)
+    for reldir,lines in _batches(prts,nbatches):
+        uses = _Rooted(root,reldir).uses(view=fun is view_to_tree) #no chdir: other threads share the cwd
+        await loop.run_in_executor(executor,partial(fun,lines,r=_r,stats=stats,eprint=eprint,removals=removals
+                                                    ,**kwargs,**uses))
 
 #classes
+_MAGIC = b'TXDIR\x00\x01\n' #format version 1
+_SNAPSHOT = struct.Struct('<8sqqq') #magic, nodes, strings, string bytes
+_DIR,_LINK,_FILE = 0,1,2
 class TxDir:
     """
     ``TxDir`` can hold a directory in memory. Its ``content`` represents
@@ -576,11 +2432,21 @@ class TxDir:
 
     def __iter__(self):
         """Iterate over leaves, i.e. omitting inner nodes"""
-        if self.isdir() and self.content:
-            for child in self.content:
-                yield from child
-        else:
-            yield self
+        for _,e in self.walk():
+            yield e
+
+    def walk(self):
+        """Iterate over (path, leaf), the path carried down from self"""
+        stack = [(self.path(),self)]
+        pop,push = stack.pop,stack.append
+        while stack:
+            pth,e = pop()
+            c = e.content
+            if c and isinstance(c,list):
+                for child in reversed(c):
+                    push((pth+'/'+child.name if pth else child.name,child))
+            else:
+                yield pth,e
 
     def __lt__(self,other):
         return self.name<other.name
@@ -703,52 +2569,35 @@ class TxDir:
         return root
 
     @staticmethod
-    def fromview(viewstr,eprint=eprint):
+    def fromview(viewstr,eprint=eprint,removals=False):
         """Builds the directory from an indented view.
 
         viewstr:
-            A string from the output of TxDir.view().
+            A string from the output of TxDir.view(), or a list of its lines.
+        removals:
+            Remove the entries ending in `` ><``, as in a ``tree_delta``.
 
         """
 
         root = TxDir()
-        current = root
-        def _cwd():
-            return current
-        def _cd(apath):
-            nonlocal current
-            if isinstance(apath,str):
-                current = next(x for x in current.content if x.name==apath)
-            else:
-                current = apath
-        view_str_list = viewstr.splitlines()
-        view_to_tree(view_str_list
-                     ,cwd=lambda:'/'+current.path()
-                     ,mkdir=lambda apath: current.mkdir(apath)
-                     ,symlink=lambda lnk,apath: current.mkdir(apath,lnk)
-                     ,withcwd=lambda x: with_cwd(x,_cwd,_cd)
-                     ,filewrite=lambda apath,c: current.mkdir(apath,tuple(c))
-                     ,eprint=eprint
-                     )
+        view_str_list = viewstr.splitlines() if isinstance(viewstr,str) else viewstr
+        view_to_tree(view_str_list,fullpthroot='/',eprint=eprint,removals=removals,**_Nodes(root).uses())
         return root
 
     @staticmethod
-    def fromflat(flatstr,eprint=eprint):
+    def fromflat(flatstr,eprint=eprint,removals=False):
         """Builds the directory from a flat listing.
 
         flatstr:
-            A string from the output of TxDir.flat().
+            A string from the output of TxDir.flat(), or an iterable of its lines.
+        removals:
+            Remove the entries ending in `` ><``, as in a ``tree_delta``.
 
         """
 
         root = TxDir()
-        flat_str_list = flatstr.splitlines()
-        flat_to_tree(flat_str_list
-                     ,mkdir=lambda apath: root.mkdir(apath)
-                     ,symlink=lambda lnk,apath: root.mkdir(apath,lnk)
-                     ,filewrite=lambda apath,c: root.mkdir(apath,tuple(c))
-                     ,eprint=eprint
-                     )
+        flat_str_list = flatstr.splitlines() if isinstance(flatstr,str) else flatstr
+        flat_to_tree(flat_str_list,eprint=eprint,removals=removals,**_Nodes(root).uses(view=False))
         return root
 
     @staticmethod
@@ -759,13 +2608,20 @@ class TxDir:
          ,with_binary=False
          ,maxdepth=MAXDEPTH
          ):
-        v = '\n'.join(tree_to_view(root
-             ,with_dot=with_dot
-             ,with_files=with_files
-             ,with_content=with_content
-             ,with_binary=with_binary
-             ,maxdepth=maxdepth
-             ))
+        """Builds the directory from a directory, or from a tar or zip file."""
+        uses = {}
+        with contextlib.ExitStack() as es:
+            if isfile(root) and isarchive(root):
+                uses = es.enter_context(ArchiveSource(root)).uses()
+                root = '/'
+            v = list(tree_to_view(root
+                 ,with_dot=with_dot
+                 ,with_files=with_files
+                 ,with_content=with_content
+                 ,with_binary=with_binary
+                 ,maxdepth=maxdepth
+                 ,**uses
+                 ))
         return TxDir.fromview(v)
 
     def view(self
@@ -776,158 +2632,1016 @@ class TxDir:
          ,maxdepth=MAXDEPTH
          ):
         """return an indented text view as string"""
-        resv = '\n'.join(tree_to_view(self
-            ,with_dot=with_dot
+        return '\n'.join(self.viewlines(
+             with_dot=with_dot
             ,with_files=with_files
             ,with_content=with_content
             ,with_binary=with_binary
             ,maxdepth=maxdepth
-            ,isdir=lambda x: x.isdir()
-            ,normjoin=lambda *x: x[-2].cd(x[-1]) if isinstance(x[-1],str) else x[-1]
-            ,islink=lambda x: x.islink()
-            ,listdir=lambda x: x.content
-            ,filecontent=lambda x,**k: x.content
-            ,readlink=lambda x: x.content
-            ,name=lambda x: x.name
-            ,up=lambda x: x.parent if x.parent else x
             ))
-        return resv
+
+    def viewlines(self
+         ,with_dot=False
+         ,with_files=True
+         ,with_content=True
+         ,with_binary=False
+         ,maxdepth=MAXDEPTH
+         ):
+        """
+        Generator for the lines of ``view()``.
+        Same as ``tree_to_view`` on the file system, but walking the nodes directly.
+        """
+        lenprefix = len(MID_END[0])
+        def content(x,**k):
+            return x.content
+        gitignore = GitIgnore(self
+                     ,listdir=content
+                     ,up=lambda x: x.parent if x.parent else x
+                     ,normjoin=lambda x,n: x.cd(n)
+                     ,filecontent=content
+                     ,name=lambda x: x.name)
+        def _tree(node, prefix):
+            ds = node.content
+            lends = len(ds)
+            if len(prefix)//lenprefix >= maxdepth:
+                return
+            for i, e in enumerate(sorted(ds)):
+                if gitignore(e):
+                    continue
+                dn = e.name
+                if not with_dot and dn.startswith('.'):
+                    continue
+                last = i==lends-1
+                padding = prefix + MID_END[last]
+                c = e.content
+                if isinstance(c,str):
+                    yield padding + dn + ' ' + LNKR + ' ' + c
+                elif isinstance(c,list):
+                    yield padding + dn + '/'
+                    yield from _tree(e, prefix + SUB_MID_END[last])
+                elif with_files:
+                    yield padding + dn
+                    if with_content:
+                        tpad = ' '*len(prefix + 2*SUB_MID_END[1])
+                        yield from fileyield(e,tpad
+                                             ,with_binary=with_binary
+                                             ,filecontent=content
+                                             )
+        return _tree(self, '')
 
     def flat(self):
         """return flat listing as string"""
-        flines = ['']
-        def print(v='',end='\n'):
-            if flines[-1].endswith('\n'):
-                flines.append('')
-            flines[-1] = flines[-1]+v+end
-        for e in self:
-            print(e.path(),end='')
+        flines = []
+        add = flines.append
+        pad = SUB_MID_END[1]
+        for pth,e in self.walk():
             if e.islink():
-                print(' '+LNKR+' '+e.content)
+                add(pth+' '+LNKR+' '+e.content+'\n')
             elif e.isdir():
-                print('/')
+                add(pth+'/\n')
             else:
-                print()
-            if e.isfile():
-                for x in e.content:
-                    if x.strip():
-                        print(SUB_MID_END[1]+x,end='')
-                    else:
-                        print(x,end='')
+                add(pth+'\n')
+                if e.isfile():
+                    for x in e.content:
+                        add(pad+x if x.strip() else x)
         return ''.join(flines)
 
-    def tree(self):
-        """Create directory in file system"""
+    def tree(self,**uses):
+        """Create directory in file system.
+
+        uses:
+            ``mkdir``, ``symlink``, ``filewrite`` to use instead,
+            e.g. ``ArchiveSink.uses(view=False)``.
+
+        """
+
+        _mkdir = uses.get('mkdir',mkdir)
+        _symlink = uses.get('symlink',symlink)
+        _filewrite = uses.get('filewrite',filewrite)
         lastdir = None
-        for e in self:
+        for pth,e in self.walk():
+            if e.isdir():
+                lastdir = pth
+                if pth:
+                    _mkdir(pth)
+                continue
+            dpth = dirname(pth)
+            if dpth:
+                _mkdir(dpth)
             if e.islink():
-                mkdir(dirname(e.path()))
                 try:
-                    symlink(e.content,e.path())
+                    _symlink(e.content,pth)
                 except Exception:
                     pass
-            elif e.isdir():
-                lastdir = e.path()
-                mkdir(lastdir)
             else:
-                mkdir(dirname(e.path()))
-                fileput(e.path(),e.content)
+                fileput(pth,e.content,filewrite=_filewrite)
         return lastdir
 
+    def dump(self,fp):
+        """Write the tree below self to a binary file, to be read by ``TxDir.load``.
+
+        fp:
+            A file opened for binary writing.
+
+        """
+
+        from array import array
+        parents,kinds,names,refs,nlines = array('q'),bytearray(),array('q'),array('q'),array('q')
+        ends,texts = array('q'),[]
+        pos = 0
+        def text(x):
+            nonlocal pos
+            b = x.encode('utf-8','surrogatepass')
+            texts.append(b)
+            pos += len(b)
+            ends.append(pos)
+            return len(ends)-1
+        stack = [(-1,self)]
+        while stack:
+            p,e = stack.pop()
+            i,c = len(kinds),e.content
+            parents.append(p)
+            names.append(text(e.name))
+            if isinstance(c,list):
+                kinds.append(_DIR)
+                refs.append(0)
+                nlines.append(0) #the children are found by their parents
+                stack.extend((i,x) for x in reversed(c))
+            elif isinstance(c,str):
+                kinds.append(_LINK)
+                refs.append(text(c))
+                nlines.append(1)
+            elif isinstance(c,tuple):
+                kinds.append(_FILE)
+                refs.append(len(ends))
+                nlines.append(len(c))
+                for x in c:
+                    text(x)
+            else:
+                raise TypeError(f"{e.path()}: content must be list, str or tuple")
+        kinds.extend(bytes(-len(kinds)%8))
+        cols = [parents,names,refs,nlines,ends]
+        if sys.byteorder != 'little':
+            for a in cols:
+                a.byteswap()
+        fp.write(_SNAPSHOT.pack(_MAGIC,len(parents),len(ends),pos))
+        fp.write(kinds)
+        for a in cols:
+            fp.write(a.tobytes())
+        fp.writelines(texts)
+
+    @staticmethod
+    def load(fp,lazy=False):
+        """Read a tree written by ``TxDir.dump``.
+
+        fp:
+            A file opened for binary reading.
+        lazy:
+            Map the file and read file content and links only when accessed.
+
+        """
+
+        from array import array
+        if lazy:
+            import mmap
+            buf = mmap.mmap(fp.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            buf = fp.read()
+        try:
+            magic,n,nt,size = _SNAPSHOT.unpack_from(buf)
+        except struct.error:
+            raise ValueError("truncated snapshot") from None
+        if magic != _MAGIC:
+            raise ValueError("not a TxDir snapshot")
+        off = _SNAPSHOT.size
+        if len(buf) < off+n+(-n%8)+8*(4*n+nt)+size:
+            raise ValueError("truncated snapshot")
+        kinds = buf[off:off+n]
+        off += n+(-n%8)
+        def col(k):
+            nonlocal off
+            a = array('q')
+            a.frombytes(buf[off:off+8*k])
+            if sys.byteorder != 'little':
+                a.byteswap()
+            off += 8*k
+            return a.tolist()
+        parents,names,refs,nlines,ends = col(n),col(n),col(n),col(n),col(nt)
+        starts = [off]+[off+x for x in ends[:-1]]
+        ends = [off+x for x in ends]
+        if lazy:
+            def text(k):
+                return buf[starts[k]:ends[k]].decode('utf-8','surrogatepass')
+            def content(kind,ref,cnt):
+                if kind == _LINK:
+                    return text(ref)
+                return tuple(text(k) for k in range(ref,ref+cnt))
+        else:
+            blob = buf[off:off+size]
+            if blob.isascii():
+                blob,starts,ends = blob.decode('ascii'),[x-off for x in starts],[x-off for x in ends]
+                strs = [blob[a:b] for a,b in zip(starts,ends)]
+            else:
+                strs = [buf[a:b].decode('utf-8','surrogatepass') for a,b in zip(starts,ends)]
+        import gc
+        gcon = gc.isenabled()
+        gc.disable() #no garbage while creating many objects
+        try:
+            cls = _LazyTxDir if lazy else TxDir
+            key = '_content' if lazy else 'content'
+            new = object.__new__
+            nodes = []
+            add = nodes.append
+            for p,kind,nm,ref,cnt in zip(parents,kinds,names,refs,nlines):
+                e = new(cls)
+                if kind == _DIR:
+                    c = []
+                elif lazy:
+                    c = partial(content,kind,ref,cnt)
+                elif kind == _LINK:
+                    c = strs[ref]
+                else:
+                    c = tuple(strs[ref:ref+cnt])
+                if p < 0:
+                    e.__dict__ = {'name':'','parent':None,key:c}
+                else:
+                    parent = nodes[p]
+                    e.__dict__ = {'name':text(nm) if lazy else strs[nm],'parent':parent,key:c}
+                    parent.content.append(e)
+                add(e)
+        finally:
+            if gcon:
+                gc.enable()
+        return nodes[0]
+
+
+class _LazyTxDir(TxDir):
+    """A ``TxDir`` from ``TxDir.load(fp,lazy=True)``, reading content on first access"""
+    @property
+    def content(self):
+        c = self._content
+        if isinstance(c,partial):
+            c = self._content = c()
+        return c
+    @content.setter
+    def content(self,c):
+        self._content = c
+
+class _Nodes:
+    """
+    The file system uses of view_to_tree() and flat_to_tree() on TxDir nodes.
+    The current directory is an attribute, not the process cwd,
+    so there is no lock, and the children are looked up by name in a dict.
+    """
+    def __init__(self,root):
+        self.current = root
+        self.index = {} #id(dir) -> {name: child}
+    def children(self,d):
+        ix = self.index.get(id(d))
+        if ix is None:
+            ix = self.index[id(d)] = {x.name:x for x in d.content}
+        return ix
+    def find(self,apath):
+        c = self.current
+        for an in apath.split('/'):
+            if not an or an == '.':
+                continue
+            c = c.parent or c if an == '..' else self.children(c)[an]
+        return c
+    def make(self,apath,content):
+        c = self.current
+        names = [x for x in apath.split('/') if x and x != '.']
+        maxi = len(names)-1
+        for i,an in enumerate(names):
+            if an == '..':
+                c = c.parent or c
+                continue
+            ix = self.children(c)
+            n = ix.get(an)
+            if n is None:
+                n = ix[an] = TxDir(an,c,[] if i<maxi else content)
+            elif i == maxi and not isinstance(content,list):
+                n.content = content #overwrite, as on disk
+            c = n
+        return c
+    def remove(self,apath):
+        try:
+            e = self.find(apath)
+        except (KeyError,AttributeError):
+            return
+        if e.parent:
+            e.parent.content.remove(e)
+            self.children(e.parent).pop(e.name,None)
+    @staticmethod
+    def lines(c):
+        if isinstance(c,bytes): #decoded by fileput: keep as b'' line
+            from base64 import b64encode
+            return (repr(b64encode(c))+'\n',)
+        return tuple(c)
+    def exists(self,apath):
+        try:
+            self.find(apath)
+            return True
+        except (KeyError,AttributeError):
+            return False
+    @contextlib.contextmanager
+    def withcwd(self,apath):
+        prev = self.current
+        self.current = self.find(apath)
+        try:
+            yield
+        finally:
+            self.current = prev
+    def uses(self,view=True):
+        u = dict(mkdir=lambda apath: self.make(apath,[])
+                 ,symlink=lambda lnk,apath: self.make(apath,lnk)
+                 ,filewrite=lambda apath,c: self.make(apath,self.lines(c))
+                 ,exists=self.exists
+                 ,remove=self.remove
+                 )
+        if view:
+            u.update(cwd=lambda:'/'+self.current.path(),withcwd=self.withcwd)
+        return u
+
+class _Inotify:
+    """Watches on directories with Linux inotify, via ``ctypes``, waited for with ``select``"""
+    MASK = 0x2|0x40|0x80|0x100|0x200|0x400|0x800 #modify, moved from/to, create, delete, delete/move self
+    OVERFLOW,IGNORED = 0x4000,0x8000
+    EVENT = struct.Struct('iIII') #wd, mask, cookie, len of the name that follows
+    def __init__(self):
+        self.libc = _libc()
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+        if self.fd < 0:
+            self.error('inotify_init1')
+        self.keys = {} #wd -> key
+    @staticmethod
+    def error(what):
+        import ctypes
+        e = ctypes.get_errno()
+        raise OSError(e,os.strerror(e),what)
+    def add(self,pd,key):
+        wd = self.libc.inotify_add_watch(self.fd,os.fsencode(pd),self.MASK)
+        if wd < 0:
+            self.error(pd)
+        self.keys[wd] = key
+    def read(self,timeout):
+        """The keys with events within ``timeout`` seconds, None on queue overflow"""
+        import select
+        keys = set()
+        if not select.select([self.fd],[],[],timeout)[0]:
+            return keys
+        try:
+            data = os.read(self.fd,1<<16)
+        except BlockingIOError: # pragma: no cover
+            return keys
+        pos,size = 0,self.EVENT.size
+        while pos < len(data):
+            wd,mask,_,n = self.EVENT.unpack_from(data,pos)
+            pos += size+n
+            if mask & self.OVERFLOW:
+                return None
+            if mask & self.IGNORED: #the directory is gone
+                self.keys.pop(wd,None)
+            elif wd in self.keys:
+                keys.add(self.keys[wd])
+        return keys
+    def close(self):
+        os.close(self.fd)
+class Watcher:
+    """
+    A live view of the directory ``root``.
+    The directory is held as ``TxDir``, with the view lines of every node cached.
+    A change rescans only the directories it was reported for,
+    reads only the files whose size, mtime or inode changed,
+    and renders only the changed nodes again::
+
+        with Watcher('.') as w:
+            for lines in w.changes():
+                print('\\n'.join(lines))
+
+    Changes are reported by Linux inotify, else found by polling ``lstat``.
+    The ``.gitignore`` is read again, if the one in ``root`` changes.
+
+    :param root: the directory to watch
+    :param debounce: seconds without events that end a batch of changes
+    :param poll: seconds between the ``lstat`` passes, without inotify
+    :param inotify: else poll
+    :param stats: a ``Stats`` instance to update, counting ``rescanned`` directories
+
+    The other parameters are those of ``tree_to_view``.
+
+    """
+    def __init__(self,root='.'
+                 ,with_dot=False
+                 ,with_files=True
+                 ,with_content=True
+                 ,with_binary=False
+                 ,maxdepth=MAXDEPTH
+                 ,debounce=0.1
+                 ,poll=1.0
+                 ,inotify=True
+                 ,stats=None
+                 ):
+        self.root = root
+        self.with_dot,self.with_files,self.with_content,self.with_binary = with_dot,with_files,with_content,with_binary
+        self.maxdepth,self.debounce,self.poll,self.stats = maxdepth,debounce,poll,stats
+        self.filecontent = stats.wrap(filecontent,'filecontent',lambda a,r:_size(r or b'')) if stats else filecontent
+        self.tx = TxDir()
+        self.stamps = {} #path -> (mode, mtime_ns, size, inode)
+        self.polled = {} #path -> stamp, if changed since the scan
+        self.last = {} #node -> last in its directory
+        self.cache = {} #node -> ((prefix, last), view lines)
+        self.notify = None
+        if inotify:
+            try:
+                self.notify = _Inotify()
+            except (OSError,AttributeError): #not Linux
+                pass
+        self.gitignore,self.gistamp = GitIgnore(start=root),self._stamp(normjoin(root,'.gitignore'))
+        self.rescanall = False
+        self._scan('',self.tx)
+    def __enter__(self):
+        return self
+    def __exit__(self,*exc):
+        self.close()
+    def close(self):
+        if self.notify:
+            self.notify.close()
+            self.notify = None
+    @staticmethod
+    def _stamp(pd):
+        try:
+            st = os.lstat(pd)
+        except OSError:
+            return None
+        return (st.st_mode,st.st_mtime_ns,st.st_size,st.st_ino)
+    def _content(self,pd):
+        if not self.with_content:
+            return ()
+        try:
+            return tuple(x+'\n' for x in fileyield(pd,'',with_binary=self.with_binary,filecontent=self.filecontent))
+        except OSError:
+            return ()
+    def _forget(self,r,e):
+        self.stamps.pop(r,None)
+        self.last.pop(e,None)
+        self.cache.pop(e,None)
+        if e.isdir():
+            for c in e.content:
+                self._forget(r+'/'+c.name,c)
+    def _scan(self,rel,node,deep=False):
+        """Read directory ``rel`` into ``node`` again; returns the flat delta lines"""
+        import stat
+        pd0 = normjoin(self.root,rel) if rel else self.root
+        if self.notify:
+            try:
+                self.notify.add(pd0,rel)
+            except OSError: #e.g. out of watches
+                self.close()
+        self.stamps[rel] = self._stamp(pd0) #before listing: no change is missed by polling
+        try:
+            ds = listdir(pd0) if (rel.count('/')+1 if rel else 0) < self.maxdepth else []
+        except OSError: #gone: the parent will tell
+            return []
+        if self.stats:
+            self.stats.count('rescanned')
+        old = {e.name:e for e in node.content}
+        node.content = []
+        removed,added,subdirs = [],[],[]
+        lends = len(ds)
+        for i,d in enumerate(sorted(ds)):
+            pd = normjoin(pd0,d)
+            if self.gitignore(pd) or not self.with_dot and d.startswith('.'):
+                continue
+            r = rel+'/'+d if rel else d
+            stamp = self._stamp(pd)
+            if stamp is None:
+                continue
+            mode = stamp[0]
+            e = old.pop(d,None)
+            content = None #None: e stays
+            if stat.S_ISLNK(mode):
+                try:
+                    target = readlink(pd)
+                except OSError: # pragma: no cover
+                    target = ''
+                if e is None or e.content != target:
+                    content = target
+            elif stat.S_ISDIR(mode):
+                if e is None or not e.isdir():
+                    content = []
+                elif deep:
+                    subdirs.append((r,e))
+            elif not self.with_files:
+                continue
+            elif e is None or not e.isfile() or self.stamps.get(r) != stamp:
+                c = self._content(pd) if stat.S_ISREG(mode) else ()
+                if e is None or e.content != c:
+                    content = c
+            if content is None:
+                node.content.append(e)
+            else:
+                if e is not None:
+                    if not (e.isfile() and isinstance(content,tuple)): #a file is overwritten
+                        removed.append(r+'/ '+RMV if e.isdir() else r+' '+RMV)
+                    self._forget(r,e)
+                e = TxDir(d,node,content)
+                added.append((r,e))
+            if not stat.S_ISDIR(mode): #that of a directory is taken when listing it
+                self.stamps[r] = stamp
+            self.last[e] = i==lends-1
+        for d,e in old.items():
+            r = rel+'/'+d if rel else d
+            removed.append(r+'/ '+RMV if e.isdir() else r+' '+RMV)
+            self._forget(r,e)
+        while node is not None:
+            self.cache.pop(node,None)
+            node = node.parent
+        delta = sorted(removed)
+        for r,e in added:
+            if e.isdir():
+                self._scan(r,e,deep=True)
+            delta.extend(e.flat().splitlines())
+        for r,e in subdirs:
+            delta.extend(self._scan(r,e,deep=True))
+        return delta
+    def _lines(self,e,prefix,last):
+        """The view lines of ``e``, cached while it is unchanged at the same place"""
+        c = self.cache.get(e)
+        if c is not None and c[0] == (prefix,last):
+            return c[1]
+        padding = prefix+MID_END[last]
+        x = e.content
+        if isinstance(x,str):
+            lines = [padding+e.name+' '+LNKR+' '+x]
+        elif isinstance(x,list):
+            lines = [padding+e.name+'/']
+            self._sublines(e,prefix+SUB_MID_END[last],lines)
+        else:
+            lines = [padding+e.name]
+            tpad = ' '*len(prefix+2*SUB_MID_END[1])
+            for y in x:
+                y = y.rstrip('\n')
+                lines.append(tpad+y if y else '')
+        self.cache[e] = ((prefix,last),lines)
+        return lines
+    def _sublines(self,node,prefix,lines):
+        for e in node.content:
+            lines.extend(self._lines(e,prefix,self.last[e]))
+    def viewlines(self):
+        """The lines of ``tree_to_view(root)``, from the nodes and their cached lines"""
+        lines = []
+        self._sublines(self.tx,'',lines)
+        return lines
+    def _poll(self):
+        import stat
+        dirty = set()
+        for r,stamp in list(self.stamps.items()):
+            now = self._stamp(normjoin(self.root,r) if r else self.root)
+            if now != self.polled.get(r,stamp): #changed since the last pass
+                self.polled[r] = now
+                if now and stamp and stat.S_ISDIR(stamp[0]):
+                    dirty.add(r)
+                else:
+                    dirty.add(r.rpartition('/')[0])
+        return dirty
+    def _events(self,timeout):
+        if self.notify:
+            keys = self.notify.read(timeout)
+            if keys is None: #overflow
+                self.rescanall = True
+                keys = {''}
+            return keys
+        from time import sleep
+        sleep(self.poll if timeout is None else min(self.poll,timeout))
+        return self._poll()
+    def wait(self,timeout=None):
+        """
+        Wait for changes, then until there are none for ``debounce`` seconds.
+
+        :return: the directories to rescan, empty after ``timeout`` seconds without changes
+
+        """
+        end = None if timeout is None else perf_counter()+timeout
+        dirty = set()
+        while not dirty:
+            left = None if end is None else end-perf_counter()
+            if left is not None and left <= 0:
+                return dirty
+            dirty = self._events(left)
+        while True:
+            more = self._events(self.debounce)
+            if not more:
+                return dirty
+            dirty |= more
+    def update(self,dirty):
+        """
+        Rescan the directories ``dirty`` from ``wait``.
+
+        :return: the flat delta lines, like ``tree_delta``, empty if nothing changed
+
+        """
+        deep,self.rescanall = self.rescanall,False
+        self.polled.clear()
+        if '' in dirty:
+            gistamp = self._stamp(normjoin(self.root,'.gitignore'))
+            if gistamp != self.gistamp:
+                self.gitignore,self.gistamp = GitIgnore(start=self.root),gistamp
+                deep = True
+        if deep:
+            dirty = {''}
+        delta = []
+        for rel in sorted(dirty): #parents first: a removed directory is skipped
+            try:
+                node = self.tx.cd(rel) if rel else self.tx
+            except FileNotFoundError:
+                continue
+            if node.isdir():
+                delta.extend(self._scan(rel,node,deep))
+        return delta
+    def changes(self,delta=False,timeout=None):
+        """
+        Yield the view lines, or with ``delta`` the flat delta lines, after each change.
+        Stops after ``timeout`` seconds without changes.
+        """
+        while True:
+            dirty = self.wait(timeout)
+            if not dirty:
+                return
+            lines = self.update(dirty)
+            if lines:
+                yield lines if delta else self.viewlines()
+
+_stdio,_niced = [],[]
+_digestcaches = None #path: DigestCache, shared by the jobs of a batch in this process
+def _batchworker():
+    global _digestcaches
+    _digestcaches = {} #the new digests go to the parent, see _job
+def _job(spec,stdin=True,print=None,lowpriority=False):
+    """
+    Run a job of ``batch`` with ``main``.
+    Without ``print`` the output lines are collected, for a process pool,
+    and so are the new digests of the ``-C`` caches, for the parent to save.
+
+    :return: (return code, output lines, error, seconds, {cache path: new digests})
+    """
+    chars = _tree_chars()
+    out = []
+    ret,err = 1,None
+    t0 = perf_counter()
+    try:
+        if isinstance(spec,str):
+            import json
+            spec = json.loads(spec)
+        parser = _parser()
+        if isinstance(spec,list):
+            spec = vars(parser.parse_args([str(x) for x in spec]))
+        if not isinstance(spec,dict):
+            raise ValueError("a job is a list of arguments or an object of options")
+        types = {a.dest:a.type for a in parser._actions}
+        unknown = sorted(set(spec)-set(types))
+        if unknown:
+            raise ValueError(f"unknown options {unknown}")
+        spec = {k:types[k](v) if types[k] and isinstance(v,str) else v for k,v in spec.items()}
+        if spec.get('B') or spec.get('w') or spec.get('W'):
+            raise ValueError("-B, -w and -W are not batch jobs")
+        if spec.get('q'):
+            raise ValueError("-q is for the whole batch (-B JOBS -q), as nice is for the process")
+        if not stdin and spec.get('infile','-') == '-' and (spec.get('D') or not spec.get('c')):
+            raise ValueError("stdin holds the jobs")
+        spec['q'] = lowpriority
+        ret = main(print=print or out.append,**spec)
+    except SystemExit as e: #from argparse, which printed the help or the error
+        ret = e.code if isinstance(e.code,int) else 2
+        err = 'invalid arguments' if ret else None
+    except Exception as e:
+        err = f"{type(e).__name__}: {e}"
+    finally:
+        set_tree_chars(**chars) #-a is for this job only
+    new = {}
+    if print is None and _digestcaches:
+        for pth,cache in _digestcaches.items():
+            if cache.new:
+                new[pth],cache.new = cache.new,{}
+    return ret,out,err,perf_counter()-t0,new
+def batch(jobs,processes=0,print=print,report=eprint,stdin=True,lowpriority=False):
+    """
+    Run many ``main`` jobs in one process, or in a pool of ``processes``,
+    sharing the start-up, the imports and the compiled grammars.
+    A job is a list of command line arguments or a dict of ``main`` options
+    (``{"infile": "a", "l": true}``), or either as a JSON line. Empty lines are skipped.
+    The output of the jobs is printed in order, each followed by a JSON status line to ``report``:
+    ``{"job": N, "ret": 0, "seconds": 0.01}``, with ``"error"`` if it raised.
+
+    :param jobs: iterable of jobs, e.g. an open file
+    :param processes: if > 1, run the jobs in a process pool of this size.
+        Either way, the ``-C`` digest caches are saved once at the end, with the new digests of all jobs.
+    :param stdin: False if stdin holds the jobs, so they must not read it
+    :param lowpriority: run the jobs like with ``-q``, lowering the priority of the process once;
+        ``-q`` is not allowed in the jobs
+    :return: the number of failed jobs
+
+    """
+    import json
+    global _digestcaches
+    jobs = ((n,x) for n,x in enumerate(jobs,1) if not isinstance(x,str) or x.strip())
+    caches = {}
+    def done(n,ret,out,err,seconds,new):
+        for pth,digests in new.items():
+            if pth not in caches:
+                caches[pth] = DigestCache(pth)
+            caches[pth].update(digests)
+        for x in out:
+            print(x)
+        status = dict(job=n,ret=ret,seconds=round(seconds,4))
+        if err:
+            status['error'] = err
+        report(json.dumps(status))
+        return bool(ret or err)
+    try:
+        if processes and processes > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(processes,initializer=_batchworker) as ex:
+                futures = [(n,ex.submit(_job,x,stdin,None,lowpriority)) for n,x in jobs]
+                return sum(done(n,*f.result()) for n,f in futures)
+        _digestcaches = caches
+        return sum(done(n,*_job(x,stdin,print,lowpriority)) for n,x in jobs)
+    finally:
+        for cache in caches.values():
+            cache.save()
+        _digestcaches = None
+@lru_cache(None)
+def _parser():
+    """The ``argparse`` parser of ``main``, for its command line and the list jobs of ``-B``"""
+    import argparse
+    parser = argparse.ArgumentParser(add_help=False,description='''\
+    Files/dirs are ignored via .gitignore.
+    If the directory contains unignored binary files,
+    exclude files with '-f'. Ignore content with '-n'.
+    Text file content must not have an empty first line.
+    '''
+    )
+    parser.add_argument("-h", action="help", help="Print help information.")
+    parser.add_argument(
+        "-v",
+        action="version",
+        version=f"%(prog)s {__version__}",
+        help="Print version information.",
+    )
+    parser.add_argument(
+        "-a",
+        action="store_true",
+        help="Use ASCII instead of unicode when printing the indented view.",
+    )
+    parser.add_argument(
+        "-b",
+        action="store_true",
+        help="Include content of binary files as base64 encoded.",
+    )
+    parser.add_argument(
+        "-l",
+        action="store_true",
+        help="Create a flat listing instead of an indented view.",
+    )
+    parser.add_argument(
+        "-f",
+        action="store_true",
+        help="Omit files. Only list directories.",
+    )
+    parser.add_argument(
+        "-d",
+        action="store_true",
+        help="Include dot files/directories.",
+    )
+    parser.add_argument(
+        "-n",
+        action="store_true",
+        help="Omit file content.",
+    )
+    parser.add_argument(
+        "-s",
+        action="store_true",
+        help="Print counters and timings as JSON to stderr.",
+    )
+    parser.add_argument(
+        "-g",
+        action="store_true",
+        help="List the files tracked in .git/index instead of walking the directories.",
+    )
+    parser.add_argument(
+        "-u",
+        action="store_true",
+        help="With -g, also list untracked files not ignored.",
+    )
+    parser.add_argument(
+        "-k",
+        action="store_true",
+        help="Check outdir (default .) against infile, stop at the first mismatch; exit 1 if different.",
+    )
+    parser.add_argument(
+        "-K",
+        action="store_true",
+        help="Like -k, but list all mismatches.",
+    )
+    parser.add_argument(
+        "-w",
+        action="store_true",
+        help="Watch the infile directory (default .): print the view again on each change, after a form feed line.",
+    )
+    parser.add_argument(
+        "-W",
+        action="store_true",
+        help="Like -w, but print the flat listing, then flat deltas with removed entries ending in ' ><'.",
+    )
+    parser.add_argument(
+        "-x",
+        action="store_true",
+        help="Apply into a staged copy of outdir and swap it in when complete.",
+    )
+    parser.add_argument(
+        "-j",
+        action="store",
+        default=0,
+        type=int,
+        help="Number of processes to use.",
+    )
+    parser.add_argument(
+        "-t",
+        action="store",
+        choices=['view','flat'],
+        help="Format of infile, if not detected from the first lines.",
+    )
+    parser.add_argument(
+        "-D",
+        action="store",
+        metavar="OLD",
+        help="""Make a flat delta from OLD to infile, with removed entries ending in ' ><'.
+        OLD and infile are directories, .tar/.zip files or view/flat files.
+        The delta is printed or applied to outdir.""",
+    )
+    def algo(name):
+        import hashlib
+        hashlib.new(name) #else ValueError: invalid algo value
+        return name
+    parser.add_argument(
+        "-H",
+        action="store",
+        type=algo,
+        metavar="ALGO",
+        help="""Print a manifest of infile: 'path size ALGO:hex' per file instead of the content.
+        ALGO is sha256 or blake2b (or another hashlib name).""",
+    )
+    parser.add_argument(
+        "-C",
+        action="store",
+        metavar="CACHE",
+        help="With -H, reuse and update the digests of unchanged files kept in the JSON file CACHE.",
+    )
+    parser.add_argument(
+        "-S",
+        action="store",
+        metavar="SINCE",
+        help="""Only list entries of the infile directory changed since SINCE, with their directories.
+        SINCE is seconds since the epoch, or a marker file: its mtime is used,
+        and it is set to the start of the scan afterwards (created, if missing, after a full scan).
+        Removed entries are not listed: use -D with a saved listing for them.""",
+    )
+    def size(x):
+        x = x.strip().upper().rstrip('B')
+        n = 'KMGT'.find(x[-1:]) + 1 if x[-1:].isalpha() else 0
+        return int(float(x[:-1] if n else x)*1024**n)
+    parser.add_argument(
+        "-z",
+        action="store",
+        type=size,
+        metavar="BYTES",
+        help="List larger files as 'name [N bytes omitted]', without opening them (k, M, G suffixes).",
+    )
+    parser.add_argument(
+        "-Z",
+        action="store",
+        type=size,
+        metavar="BYTES",
+        help="Like -z, for files that would exceed this total of content.",
+    )
+    parser.add_argument(
+        "-e",
+        action="store",
+        type=int,
+        metavar="ENTRIES",
+        help="List at most this many entries per directory, then './ [N entries omitted]'.",
+    )
+    parser.add_argument(
+        "-r",
+        action="store",
+        type=size,
+        metavar="BYTES",
+        help="Read and write at most this many bytes per second (k, M, G suffixes).",
+    )
+    parser.add_argument(
+        "-R",
+        action="store",
+        type=float,
+        metavar="FILES",
+        help="Read and write at most this many files per second.",
+    )
+    parser.add_argument(
+        "-q",
+        action="store_true",
+        help="Low priority: lower the CPU and thereby I/O priority, and drop the files read from the page cache.",
+    )
+    parser.add_argument(
+        "-B",
+        action="store",
+        metavar="JOBS",
+        help="""Run the jobs in the file JOBS (- is stdin) in this process, or in -j processes:
+        one JSON list of command line arguments, or JSON object of option names and values, per line.
+        The output of each job is printed in order; a JSON status line per job goes to stderr.
+        With -q, all jobs run at low priority; -q is not allowed in the jobs.
+        Exit 1 if a job failed.""",
+    )
+    parser.add_argument(
+        "-m",
+        action="store",
+        default=MAXDEPTH,
+        type=int,
+        help="Maximum directory depth to scan.",
+    )
+    parser.add_argument(
+        "-c",
+        nargs="*",
+        default="",
+        help="""Directories described with a DSL
+        (',' = end of token,
+        '.' = up dir,
+        '/' = down)
+        `txdir - . -c 'a/b/d.c/d..a/u,v,x,g\\.x'` produces the same as
+        `mkdir -p a/{b,c}/d a/u a/v a/x a/g.x`
+        If not within ', use \\\\ to escape.
+
+        """
+    )
+    parser.add_argument(
+        'infile',
+        nargs='?',
+        default='-',
+        help="""If a file, it is expected to contain a text representation of a directory, flat or indented (none or - is stdin).
+        If a directory, or a .tar(.gz,.bz2,.xz) or .zip file, the text view is created with file content (unless -n)."""
+    )
+    parser.add_argument(
+        'outdir',
+        nargs='?',
+        default='-',
+        help="""None or - means printing to stdout.
+        If it ends in .tar(.gz,.bz2,.xz) or .zip, the file tree is written into that archive.
+        Else, if the parameter is an existing file, nothing is done.
+        If not a directory, the directory is created.
+        The file tree is created in the directory."""
+    )
+    return parser
 
 def main(print=print,**args):
     """Command line functionality."""
+    import argparse
+    import codecs
     if args:
-        for x in 'vablfdn':
+        for x in 'vablfdnsxgukKwWq':
             args.setdefault(x,False)
         args.setdefault('m',MAXDEPTH)
+        args.setdefault('j',0)
+        args.setdefault('t',None)
+        args.setdefault('D',None)
+        args.setdefault('H',None)
+        args.setdefault('C',None)
+        args.setdefault('S',None)
+        for x in 'zZerRB':
+            args.setdefault(x,None)
         args.setdefault('c',[])
         args.setdefault('infile','-')
         args.setdefault('outdir','-')
         args=argparse.Namespace(**args)
     else:
-        parser = argparse.ArgumentParser(add_help=False,description='''\
-        Files/dirs are ignored via .gitignore.
-        If the directory contains unignored binary files,
-        exclude files with '-f'. Ignore content with '-n'.
-        Text file content must not have an empty first line.
-        '''
-        )
-        parser.add_argument("-h", action="help", help="Print help information.")
-        parser.add_argument(
-            "-v",
-            action="version",
-            version=f"%(prog)s {__version__}",
-            help="Print version information.",
-        )
-        parser.add_argument(
-            "-a",
-            action="store_true",
-            help="Use ASCII instead of unicode when printing the indented view.",
-        )
-        parser.add_argument(
-            "-b",
-            action="store_true",
-            help="Include content of binary files as base64 encoded.",
-        )
-        parser.add_argument(
-            "-l",
-            action="store_true",
-            help="Create a flat listing instead of an indented view.",
-        )
-        parser.add_argument(
-            "-f",
-            action="store_true",
-            help="Omit files. Only list directories.",
-        )
-        parser.add_argument(
-            "-d",
-            action="store_true",
-            help="Include dot files/directories.",
-        )
-        parser.add_argument(
-            "-n",
-            action="store_true",
-            help="Omit file content.",
-        )
-        parser.add_argument(
-            "-m",
-            action="store",
-            default=MAXDEPTH,
-            type=int,
-            help="Maximum directory depth to scan.",
-        )
-        parser.add_argument(
-            "-c",
-            nargs="*",
-            default="",
-            help="""Directories described with a DSL
-            (',' = end of token,
-            '.' = up dir,
-            '/' = down)
-            `txdir - . -c 'a/b/d.c/d..a/u,v,x,g\\.x'` produces the same as
-            `mkdir -p a/{b,c}/d a/u a/v a/x a/g.x`
-            If not within ', use \\\\ to escape.
-
-            """
-        )
-        parser.add_argument(
-            'infile',
-            nargs='?',
-            default='-',
-            help="""If a file, it is expected to contain a text representation of a directory, flat or indented (none or - is stdin).
-            If a directory, the text view is created with file content (unless -n)."""
-        )
-        parser.add_argument(
-            'outdir',
-            nargs='?',
-            default='-',
-            help="""None or - means printing to stdout.
-            If the parameter is an existing file, nothing is done.
-            If not a directory, the directory is created.
-            The file tree is created in the directory."""
-        )
-        args = parser.parse_args()
+        args = _parser().parse_args()
+
+    if not _stdio: #once, as batch jobs call main again
+        _stdio.append(True)
+        try:
+            sys.stdin = codecs.getreader("utf-8")(sys.stdin.detach())
+            sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
+            sys.stderr = codecs.getwriter("utf-8")(sys.stderr.detach())
+        except Exception:
+            pass
+    if args.q and not _niced: #once: nice adds up
+        _niced.append(True)
+        try:
+            os.nice(10) #the I/O priority follows, if not set
+        except (AttributeError,OSError): # pragma: no cover
+            pass
+    if args.B:
+        if args.B == '-':
+            return 1 if batch(sys.stdin,args.j,print=print,stdin=False,lowpriority=args.q) else 0
+        with open(args.B,encoding='utf-8') as f:
+            return 1 if batch(f,args.j,print=print,lowpriority=args.q) else 0
 
     infile       = args.infile
     outdir       = args.outdir
@@ -936,7 +3650,14 @@ def main(print=print,**args):
     with_content = not args.n
     with_binary  = args.b
     maxdepth     = args.m
+    jobs         = args.j
     trees        = args.c
+    stats        = Stats() if args.s else None
+    t0           = perf_counter()
+    rl           = None
+
+    if args.r or args.R or args.q:
+        rl = RateLimit(args.r,args.R,dontneed=args.q,stats=stats)
 
     if args.a:
         set_ascii()
@@ -945,52 +3666,189 @@ def main(print=print,**args):
     if trees:
         tx = TxDir.fromcmds(trees)
 
-    try:
-        sys.stdin = codecs.getreader("utf-8")(sys.stdin.detach())
-        sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
-        sys.stderr = codecs.getreader("utf-8")(sys.stderr.detach())
-    except Exception:
-        pass
+    phase = stats.phase if stats else lambda x: contextlib.nullcontext()
+    if args.w or args.W:
+        with Watcher('.' if infile == '-' else infile
+                     ,with_dot=with_dot
+                     ,with_files=with_files
+                     ,with_content=with_content
+                     ,with_binary=with_binary
+                     ,maxdepth=maxdepth
+                     ,stats=stats
+                     ) as w:
+            try:
+                print(w.tx.flat().rstrip('\n') if args.W or args.l else '\n'.join(w.viewlines()))
+                for lines in w.changes(delta=args.W):
+                    if args.l and not args.W:
+                        lines = w.tx.flat().splitlines()
+                    print('\f\n'+'\n'.join(lines))
+                    sys.stdout.flush()
+            except KeyboardInterrupt:
+                pass
+        if stats:
+            eprint(stats.json())
+        return 0
     fview = []
+    copied = False
     inf = isfile(infile)
-    if not inf and infile == '-':
+    arch = inf and isarchive(infile)
+    if args.D:
+        with phase('delta'):
+            new = infile
+            if not inf and infile == '-':
+                new = _totxdir([x.rstrip() for x in sys.stdin.readlines()])
+            fview = list(tree_delta(args.D,new
+                                    ,with_dot=with_dot
+                                    ,maxdepth=maxdepth
+                                    ,stats=stats
+                                    ))
+    elif not inf and infile == '-':
         if not trees:
-            fview = [x.rstrip() for x in sys.stdin.readlines()]
-    elif inf:
-        with open(infile,'r',encoding='utf-8') as f:
-            fview = [x.rstrip() for x in f.readlines()]
-    elif isdir(infile):
-        if args.l:
-            fview = list(tree_to_flat(infile
-                        ,with_dot=with_dot
-                        ,with_files=with_files
-                        ,with_content=with_content
-                        ,with_binary=with_binary
-                        ,maxdepth=maxdepth
+            with phase('read'):
+                fview = [x.rstrip() for x in sys.stdin.readlines()]
+    elif inf and not arch:
+        with phase('read'):
+            with open(infile,'r',encoding='utf-8') as f:
+                fview = [x.rstrip() for x in f.readlines()]
+    elif (isdir(infile) and outdir != '-' and not isfile(outdir) and not isarchive(outdir)
+          and not (args.k or args.K or args.H or args.S)
+          and args.z is None and args.Z is None and args.e is None):
+        copied = True
+        with phase('copy'):
+            if args.x:
+                into = staged(outdir,stats=stats,**(dict(filecopy=rl.reading(filecopy)) if rl else {}))
+            else:
+                into = contextlib.nullcontext(outdir)
+            with into as odir:
+                tree_to_tree(infile,odir
+                            ,with_dot=with_dot
+                            ,with_files=with_files
+                            ,with_content=with_content
+                            ,maxdepth=maxdepth
+                            ,stats=stats
+                            ,**(dict(filecopy=rl.reading(filecopy),filewrite=rl.writing(filewrite)) if rl else {})
+                            )
+                if tx:
+                    with with_cwd(odir):
+                        tx.tree(**(dict(filewrite=rl.writing(filewrite)) if rl else {}))
+    elif isdir(infile) or arch:
+        uses,root = {},infile
+        since,marker,tscan = None,None,time()-0.1 #file times are from a coarser clock
+        if args.S:
+            try:
+                since = float(args.S)
+            except ValueError:
+                marker = args.S
+                since = filetimes(marker)[0] if exists(marker) else None
+        archive = contextlib.ExitStack()
+        if arch:
+            uses,root = archive.enter_context(ArchiveSource(infile)).uses(),'/'
+        elif args.g:
+            try:
+                uses = GitIndex(infile,untracked=args.u).uses()
+            except (OSError,ValueError) as err:
+                eprint('-g:',err)
+        if rl:
+            size = uses.get('filesize',getsize)
+            uses = dict(uses
+                        ,filecontent=rl.reading(uses.get('filecontent',filecontent),size,fs=not arch)
+                        ,filedigest=rl.reading(uses.get('filedigest',filedigest),size,fs=not arch))
+        digests = DigestCache(args.C) if args.H and args.C else contextlib.nullcontext()
+        if args.H and args.C and _digestcaches is not None: #loaded once and saved by batch
+            key = os.path.abspath(args.C)
+            if key not in _digestcaches:
+                _digestcaches[key] = DigestCache(args.C)
+            digests = contextlib.nullcontext(_digestcaches[key])
+        with archive, digests as digestcache, phase('scan'):
+            if args.l:
+                fview = list(tree_to_flat(root
+                            ,with_dot=with_dot
+                            ,with_files=with_files
+                            ,with_content=with_content
+                            ,with_binary=with_binary
+                            ,maxdepth=maxdepth
+                            ,stats=stats
+                            ,jobs=jobs
+                            ,digest=args.H
+                            ,digestcache=digestcache
+                            ,since=since
+                            ,maxfilebytes=args.z
+                            ,maxbytes=args.Z
+                            ,maxentries=args.e
+                            ,**uses
+                                          ))
+            else:
+                fview = list(tree_to_view(root
+                                 ,with_dot=with_dot
+                                 ,with_files=with_files
+                                 ,with_content=with_content
+                                 ,with_binary=with_binary
+                                 ,maxdepth=maxdepth
+                                 ,stats=stats
+                                 ,jobs=jobs
+                                 ,digest=args.H
+                                 ,digestcache=digestcache
+                                 ,since=since
+                                 ,maxfilebytes=args.z
+                                 ,maxbytes=args.Z
+                                 ,maxentries=args.e
+                                 ,**uses
                                       ))
-        else:
-            fview = list(tree_to_view(infile
-                             ,with_dot=with_dot
-                             ,with_files=with_files
-                             ,with_content=with_content
-                             ,with_binary=with_binary
-                             ,maxdepth=maxdepth
-                                  ))
-    outf = isfile(outdir)
-    if not outf:
-        if outdir == '-':
-            if tx:
-                print(tx.flat()) if args.l else print(tx.view())
-            if fview:
-                print('\n'.join(fview))
-        else: #dir
-            mkdir(outdir)
-            with with_cwd(outdir):
+        if marker:
+            open(marker,'a').close()
+            os.utime(marker,(tscan,tscan))
+    if stats:
+        stats.count('lines',len(fview))
+    outarch = outdir != '-' and isarchive(outdir)
+    outf = isfile(outdir) and not outarch
+    ret = 0
+    if args.k or args.K:
+        with phase('verify'):
+            mismatches = verify(fview or (tx.flat().splitlines() if tx else [])
+                                ,'.' if outdir == '-' else outdir
+                                ,jobs=jobs
+                                ,full=args.K
+                                ,with_dot=with_dot
+                                ,fmt='flat' if args.D or tx and not fview else args.t
+                                ,stats=stats
+                                )
+        if mismatches:
+            print('\n'.join(f'{pth}: {reason}' for pth,reason in mismatches))
+            ret = 1
+    elif args.H or not outf:
+        if outdir == '-' or args.H: #a manifest is not applied
+            with phase('output'):
                 if tx:
-                    tx.tree()
+                    print(tx.flat()) if args.l else print(tx.view())
                 if fview:
-                    to_tree(fview)
-    return 0
+                    print('\n'.join(fview))
+        elif outarch:
+            with phase('apply'):
+                with ArchiveSink(outdir) as sink:
+                    throttle = dict(filewrite=rl.writing(sink.filewrite)) if rl else {}
+                    if tx:
+                        tx.tree(**dict(sink.uses(view=False),**throttle))
+                    if fview:
+                        to_tree(fview,stats=stats,fmt='flat' if args.D else args.t,removals=bool(args.D)
+                                ,**dict(sink.uses(),**throttle))
+        elif not copied: #dir
+            with phase('apply'):
+                throttle = dict(filewrite=rl.writing(filewrite)) if rl else {}
+                if args.x:
+                    into = staged(outdir,stats=stats,**(dict(filecopy=rl.reading(filecopy)) if rl else {}))
+                else:
+                    mkdir(outdir)
+                    into = contextlib.nullcontext(outdir)
+                with into as odir, with_cwd(odir):
+                    if tx:
+                        tx.tree(**throttle)
+                    if fview:
+                        to_tree(fview,stats=stats,jobs=jobs,fmt='flat' if args.D else args.t,removals=bool(args.D)
+                                ,**throttle)
+    if stats:
+        stats.time('total',perf_counter()-t0)
+        eprint(stats.json())
+    return ret
 
 
 if __name__ == "__main__":